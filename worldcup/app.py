@@ -2,19 +2,23 @@
 
 import datetime
 import functools
+import gzip
+import hashlib
 import requests
+import time
 from urllib.parse import urlencode
 
-from flask import Flask, session, render_template, request, redirect, url_for, g, abort
-from pymongo import MongoClient
+import click
+from flask import Flask, Response, session, render_template, request, redirect, url_for, g, abort, json, jsonify
+from flask import has_request_context
 from werkzeug.local import LocalProxy
 
-from . import config
+from . import config, metrics, monitor, storage
 
 app = Flask(__name__)
 app.config.from_object(config)
 
-dbclient = app.dbclient = MongoClient(app.config['MONGO_URI'])
+dbclient = app.dbclient = storage.connect(app.config['MONGO_URI'])
 logindb = app.logindb = dbclient[app.config['MONGO_LOGINDB']]
 
 
@@ -39,6 +43,11 @@ def get_tournament(dbname, default=None):
 
 from . import model, cli    # noqa
 
+if app.config['CHECK_INDEXES']:
+    missing = model.missing_indexes()
+    if missing:
+        app.logger.warning('Missing indexes, run `flask ensure_indexes`: %s', ', '.join(missing))
+
 
 @app.template_filter('_ts')
 def _ts(time: datetime.datetime) -> int:
@@ -78,10 +87,48 @@ def authenticated(f):
 
 @app.before_request
 def before_request():
+    g._request_start = time.perf_counter()
+    monitor.start()
     g.me = model.find_user_by_openid(session.get('openid'))
     g.tournament = get_tournament(session.get('dbname'), default=app.config['DEFAULT_TOURNAMENT'])
 
 
+@app.after_request
+def after_request(response):
+    stats = monitor.current()
+    app.logger.info('db: endpoint=%s %s', request.endpoint, stats.summary())
+    budget = app.config['DB_QUERY_BUDGET']
+    if budget and stats.count > budget:
+        app.logger.warning('db: endpoint=%s exceeded query budget %d: %s', request.endpoint, budget, stats.summary())
+    if app.config['DB_SERVER_TIMING']:
+        response.headers.add('Server-Timing', stats.server_timing())
+    return response
+
+
+@app.teardown_request
+def observe_request_duration(exc):
+    # view 抛出异常时 after_request 不会执行 请求耗时在这里记录
+    start = g.pop('_request_start', None)
+    if start is not None:
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - start, endpoint=request.endpoint or '')
+
+
+@app.teardown_appcontext
+def log_db_stats(exc):
+    # 请求的统计在 after_request 中记录 这里只记录 CLI 命令等其他 app context
+    stats = g.get('_db_stats')
+    if has_request_context() or not stats or not stats.count:
+        return
+    ctx = click.get_current_context(silent=True)
+    app.logger.info('db: command=%s %s', ctx.info_name if ctx else '-', stats.summary())
+
+
+@app.route('/metrics', endpoint='metrics', methods=['GET'])
+def export_metrics():
+    """Prometheus 文本格式的运行指标"""
+    return Response(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/auth/complete', methods=['GET'])
 def auth_complete():
     if g.me:
@@ -149,19 +196,83 @@ def index():
     if request.method == 'POST':
         match_id = request.values.get('match-id')
         bet_choice = request.values.get('bet-choice')
-        model.update_match_gamblers(match_id=match_id, team=bet_choice, gambler=g.me)
+        if app.config['BET_QUEUE']:
+            model.bet_queue.submit(match_id=match_id, team=bet_choice, gambler=g.me)
+        else:
+            model.update_match_gamblers(match_id=match_id, team=bet_choice, gambler=g.me)
 
     matches = model.find_matches(reverse=True, limit=app.config['MAX_MATCH_DISPLAY'])
+    if app.config['BET_QUEUE']:
+        matches = model.bet_queue.apply(matches)
     return render_template('index.html', matches=matches)
 
 
-@app.route('/board', methods=['GET'])
+@app.route('/matches', methods=['GET'])
 @authenticated
-def board():
-    many_series = model.generate_series()
+def more_matches():
+    """index 向下滚动时 返回 before 之前一页比赛的 html 片段"""
+    matches = model.find_matches(reverse=True, limit=app.config['MAX_MATCH_DISPLAY'],
+                                 before_id=request.args.get('before'))
+    if app.config['BET_QUEUE']:
+        matches = model.bet_queue.apply(matches)
+    return render_template('_matches.html', matches=matches)
+
+
+def match_json(match: model.Match) -> dict:
+    """投注后更新单场比赛所需的数据"""
+    def _side_json(side: dict) -> dict:
+        return dict(team=side['team'], owner=side['owner'] and str(side['owner']),
+                    score=side['score'], gamblers=[str(name) for name in side['gamblers']])
+    return dict(id=match.id, can_bet=match.can_bet(), a=_side_json(match.a), b=_side_json(match.b))
 
-    match_ids = many_series and many_series[0].points.keys() or []
-    labels = ['{1} vs {2}'.format(*match_id.split('-')) for match_id in sorted(match_ids)]  # 用 sorted() 确保 match_ids 有序
+
+@app.route('/api/bet', methods=['POST'])
+@authenticated
+def api_bet():
+    """投注 只返回该场比赛"""
+    match_id = request.values.get('match-id')
+    bet_choice = request.values.get('bet-choice')
+    if bet_choice not in ('a', 'b'):
+        return abort(400)
+
+    if app.config['BET_QUEUE']:
+        match = model.find_match_by_id(match_id)
+        if not match:
+            return abort(404)
+        # 与写入时的 _bet_window 条件相同 投注时间外的投注不放入队列
+        accepted = match.can_bet()
+        if accepted:
+            model.bet_queue.submit(match_id=match_id, team=bet_choice, gambler=g.me)
+        model.bet_queue.apply([match])
+    else:
+        accepted = model.update_match_gamblers(match_id=match_id, team=bet_choice, gambler=g.me)
+        match = model.find_match_by_id(match_id)
+        if not match:
+            return abort(404)
+    return jsonify(accepted=accepted, match=match_json(match))
+
+
+# 已生成的 board 数据 (dbname, mode, max_points) -> (version, data) 数据版本变化前一直有效
+_board_cache = model.TTLCache(maxsize=app.config['BOARD_CACHE_SIZE'], ttl=float('inf'))
+
+
+def board_data(version: str, mode=None, max_points=0) -> dict:
+    """生成 board 数据 同一 tournament 同一数据版本只生成一次
+
+    指定 mode 时按 model.downsample_series() 降采样
+    """
+    key = (g.tournament.dbname, mode, max_points)
+    cached = _board_cache.get(key, None)
+    metrics.cache_lookup('board', bool(cached and cached[0] == version))
+    if cached and cached[0] == version:
+        return cached[1]
+
+    many_series = model.find_series()
+    if mode:
+        many_series = model.downsample_series(many_series, max_points, mode, g.tournament.weight_schedule)
+
+    match_ids = sorted(many_series and many_series[0].points.keys() or [])  # 用 sorted() 确保 match_ids 有序
+    labels = ['{1} vs {2}'.format(*match_id.split('-')) for match_id in match_ids]
 
     datasets = []
     for i, series in enumerate(many_series):
@@ -171,15 +282,87 @@ def board():
                              borderColor=color, backgroundColor=color))
 
     # 插入初始 0 值
+    match_ids.insert(0, '')
     labels.insert(0, '')
     for d in datasets:
         d['data'].insert(0, 0)
 
     data = dict()
+    data['version'] = version
+    data['ids'] = match_ids
     data['labels'] = labels
     data['datasets'] = datasets
 
-    return render_template('board.html', label_count=len(labels), data=data)
+    _board_cache.set(key, (version, data))
+    return data
+
+
+def board_delta(data: dict, since: str) -> dict:
+    """返回 since 之后新结算的比赛 since 不在当前数据中时返回全量"""
+    if since not in data['ids']:
+        return dict(data, full=True)
+    start = data['ids'].index(since) + 1
+    return dict(
+        version=data['version'],
+        full=False,
+        ids=data['ids'][start:],
+        labels=data['labels'][start:],
+        datasets=[dict(d, data=d['data'][start:]) for d in data['datasets']],
+    )
+
+
+def gzip_json(payload: dict):
+    """返回 JSON response 客户端支持时以 gzip 压缩"""
+    response = app.response_class(json.dumps(payload), mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(response.get_data()))
+        response.content_encoding = 'gzip'
+    return response
+
+
+@app.route('/board', methods=['GET'])
+@authenticated
+def board():
+    return render_template('board.html')
+
+
+@app.route('/api/board', methods=['GET'])
+@authenticated
+def api_board():
+    # ledger 过期或从未建立时先重建 使版本号与数据一致
+    model.ensure_ledger()
+    version, updated_at = model.find_version()
+    # 客户端已有的数据版本及最后一场比赛
+    client_version = request.args.get('version')
+    since = request.args.get('since')
+    mode = request.args.get('mode', app.config['BOARD_DOWNSAMPLE'])
+    # points 不超过 BOARD_MAX_POINTS (0 为不限制)
+    max_points = max(request.args.get('points', app.config['BOARD_MAX_POINTS'], type=int), 0)
+    if app.config['BOARD_MAX_POINTS']:
+        max_points = min(max_points, app.config['BOARD_MAX_POINTS'])
+    # since 可能含中文 取摘要放入 ETag
+    etag = '{}-{}-{}'.format(g.tournament.dbname, version, hashlib.md5('{}|{}|{}|{}'.format(
+        client_version or '', since or '', mode, max_points).encode()).hexdigest()[:8])
+
+    # 数据未变化时直接返回 304
+    if request.if_none_match.contains(etag) or (
+            not request.if_none_match and updated_at and request.if_modified_since
+            and request.if_modified_since.replace(tzinfo=None) >= updated_at):
+        response = app.response_class(status=304)
+    else:
+        # 客户端版本之后只在末尾追加了比赛时返回增量 (不降采样) 否则返回全量
+        delta = since is not None and client_version is not None and model.appended_since(client_version)
+        if delta or mode not in ('lttb', 'round') or (mode == 'lttb' and not max_points):
+            mode, max_points = None, 0
+        data = board_data(version, mode, max_points)
+        response = gzip_json(board_delta(data, since) if delta else dict(data, full=True))
+
+    response.set_etag(etag)
+    response.last_modified = updated_at
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route('/rule', methods=['GET'])
@@ -0,0 +1,282 @@
+# coding: utf-8
+"""性能基准"""
+
+import bson.json_util
+import contextlib
+import datetime
+import json
+import os
+import random
+import subprocess
+import time
+import tracemalloc
+from typing import Iterator, List
+
+from flask import g
+
+from worldcup import app as _app, match_getter, model
+from worldcup.app import app, dbclient, tournamentdb
+from worldcup.config import Tournament
+
+
+def timeit(func, *args, repeat=5, **kwargs) -> float:
+    """返回 func 多次运行中最快一次的耗时 (秒)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_parser(pages: dict, repeat=5) -> dict:
+    """各解析后端解析每个页面的耗时
+
+    :param pages: {name: page}
+    :return: {parser: {name: seconds}}
+    """
+    date = datetime.date(2018, 7, 15)
+    return {parser: {name: timeit(match_getter.parse_match_page, page, date, parser=parser, repeat=repeat)
+                     for name, page in pages.items()}
+            for parser in match_getter.PARSERS}
+
+
+def compare_parsers(pages: dict) -> List[str]:
+    """返回各解析后端结果不一致的页面
+
+    :param pages: {name: page}
+    """
+    date = datetime.date(2018, 7, 15)
+    return [name for name, page in pages.items()
+            if len({repr(match_getter.parse_match_page(page, date, parser=parser))
+                    for parser in match_getter.PARSERS}) > 1]
+
+
+SYNTHETIC_HANDICAPS = ['平手', '平手/半球', '半球', '受半球', '半球/一球', '受一球', '一球/球半', '受球半']
+
+
+def synthetic_matches(count: int, teams=32, gamblers=16, seed=0) -> List[dict]:
+    """生成 count 场比赛的数据库记录 (与 Match._asdict() 结构相同)"""
+    rng = random.Random(seed)
+    team_names = [f'team{i}' for i in range(teams)]
+    gambler_names = [f'gambler{i}' for i in range(gamblers)]
+    start = datetime.datetime(2018, 6, 1, 12)
+    docs = []
+    for i in range(count):
+        team_a, team_b = rng.sample(team_names, 2)
+        match_time = start + datetime.timedelta(hours=i)
+        handicap_display = rng.choice(SYNTHETIC_HANDICAPS)
+        bettors = rng.sample(gambler_names, rng.randint(0, gamblers))
+        split = rng.randint(0, len(bettors))
+        docs.append(dict(
+            id=model._generate_match_id(match_time, team_a, team_b),
+            league='synthetic',
+            match_time=match_time,
+            handicap_display=handicap_display,
+            handicap=list(model._generate_handicap_pair(handicap_display)),
+            a=dict(team=team_a, premium=round(rng.uniform(1.7, 2.2), 2), score=rng.randint(0, 4),
+                   gamblers=bettors[:split]),
+            b=dict(team=team_b, premium=round(rng.uniform(1.7, 2.2), 2), score=rng.randint(0, 4),
+                   gamblers=bettors[split:]),
+            weight=rng.choice([2, 4, 8]),
+        ))
+    return docs
+
+
+def _hydrate_init(m: dict) -> model.Match:
+    """经 Match.__init__ 构造 (重新解析 handicap / score 并查询 owner)"""
+    match = model.Match(league=m['league'], match_time=m['match_time'], handicap_display=m['handicap_display'],
+                        team_a=m['a']['team'], premium_a=m['a']['premium'], score_a=m['a']['score'],
+                        team_b=m['b']['team'], premium_b=m['b']['premium'], score_b=m['b']['score'],
+                        weight=m['weight'], id=m['id'])
+    match.a['gamblers'] = m['a']['gamblers']
+    match.b['gamblers'] = m['b']['gamblers']
+    return match
+
+
+class _DictMatch:
+    """不使用 __slots__ 的 Match (属性存于 __dict__ a / b 为 dict) 作为内存占用的对照"""
+
+
+def _hydrate_dict(m: dict, owners: dict) -> _DictMatch:
+    """与 Match.from_mongo() 相同的字段 存为 __dict__ / dict"""
+    match = _DictMatch()
+    match.league = m['league']
+    match.match_time = m['match_time']
+    match.handicap_display = m['handicap_display']
+    match.handicap = tuple(m['handicap'])
+    match.a = dict(m['a'], owner=owners.get(m['a']['team']))
+    match.b = dict(m['b'], owner=owners.get(m['b']['team']))
+    match.weight = m['weight']
+    match.id = m['id']
+    match._result = None
+    return match
+
+
+def _traced_bytes(func, *args) -> int:
+    """func 返回值占用的内存 (字节)"""
+    tracemalloc.start()
+    try:
+        result = func(*args)    # noqa 持有返回值直到统计完成
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_match(docs: List[dict], repeat=3) -> dict:
+    """比较 Match 两种构造方式的耗时 以及构造结果的内存占用
+
+    :return: {'init': seconds, 'from_mongo': seconds, 'bytes': bytes, 'dict_bytes': bytes}
+        dict_bytes 为相同字段存于 __dict__ / dict 时的内存占用
+    """
+    owners = {}
+    for m in docs:
+        for side in (m['a'], m['b']):
+            owners.setdefault(side['team'], model.Gambler('owner-' + side['team']))
+    # 预置 owner 缓存 基准不访问数据库
+    g._team_owners = {tournamentdb.name: owners}
+
+    return dict(
+        init=timeit(lambda: [_hydrate_init(m) for m in docs], repeat=repeat),
+        from_mongo=timeit(lambda: [model.Match.from_mongo(m, owners) for m in docs], repeat=repeat),
+        bytes=_traced_bytes(lambda: [model.Match.from_mongo(m, owners) for m in docs]),
+        dict_bytes=_traced_bytes(lambda: [_hydrate_dict(m, owners) for m in docs]),
+    )
+
+
+HISTORY_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'history')
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'testdata')
+
+
+def history_tournament(name: str) -> dict:
+    """读取 history/<name> 中保存的赛事数据 {collection: [document]}"""
+    collections = {}
+    for collection in ('gambler', 'auction', 'match'):
+        with open(os.path.join(HISTORY_DIR, name, collection + '.json')) as f:
+            collections[collection] = [bson.json_util.loads(line) for line in f if line.strip()]
+    return collections
+
+
+def synthetic_tournament(matches=10000, gamblers=500, teams=64, seed=0) -> dict:
+    """生成合成赛事数据 {collection: [document]}"""
+    rng = random.Random(seed)
+    gambler_names = [f'gambler{i}' for i in range(gamblers)]
+    return dict(
+        gambler=[dict(name=name) for name in gambler_names],
+        auction=[dict(team=f'team{i}', gambler=rng.choice(gambler_names), price=rng.randint(1, 100))
+                 for i in range(teams)],
+        match=synthetic_matches(matches, teams=teams, gamblers=gamblers, seed=seed),
+    )
+
+
+@contextlib.contextmanager
+def scratch_tournament(name: str, collections: dict) -> Iterator[Tournament]:
+    """把数据导入临时 tournament 数据库 结束后删除"""
+    tournament = Tournament(dbname=f'bench-{name}', league=name, display=name, weight_schedule=[])
+    app.config['TOURNAMENTS'].append(tournament)
+    dbclient.drop_database(tournament.dbname)
+    previous = g.get('tournament')
+    g.tournament = tournament
+    try:
+        for collection, docs in collections.items():
+            if docs:
+                tournamentdb[collection].insert_many([dict(d) for d in docs])
+        model.update_ledger()
+        yield tournament
+    finally:
+        dbclient.drop_database(tournament.dbname)
+        app.config['TOURNAMENTS'].remove(tournament)
+        model.clear_caches()
+        g.pop('_team_owners', None)
+        if previous is None:
+            g.pop('tournament', None)
+        else:
+            g.tournament = previous
+
+
+def bench_tournament(tournament: Tournament, repeat=3) -> dict:
+    """当前 tournament 各主要路径的耗时 {name: seconds}"""
+    gamblers = model.find_gamblers()
+    matches = model.find_matches()
+    results = dict(
+        find_matches=timeit(model.find_matches, repeat=repeat),
+        generate_series=timeit(model.generate_series, repeat=repeat),
+        update_profit_and_loss_result=timeit(
+            lambda: [m.update_profit_and_loss_result(required_gamblers=gamblers) for m in matches], repeat=repeat),
+    )
+
+    # 页面渲染 以临时用户登录
+    user = model.insert_user(name='bench', openid='bench-openid')
+    try:
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['openid'] = user.openid
+            session['dbname'] = tournament.dbname
+
+        def _get(url):
+            r = client.get(url)
+            assert r.status_code == 200, f'{url}: {r.status_code}'
+
+        def _api_board():
+            _app._board_cache.clear()   # 不计缓存 测量生成 board 数据的耗时
+            _get('/api/board')
+
+        results.update({
+            'view:index': timeit(_get, '/', repeat=repeat),
+            'view:board': timeit(_get, '/board', repeat=repeat),
+            'view:api_board': timeit(_api_board, repeat=repeat),
+        })
+    finally:
+        model.drop_user(user.openid)
+    return results
+
+
+def bench_suite(scenarios: dict, repeat=3) -> List[dict]:
+    """运行全部基准
+
+    :param scenarios: {name: {collection: [document]}}
+    :return: [{'scenario': name, 'name': name, 'seconds': seconds}]
+    """
+    results = []
+    for scenario, collections in scenarios.items():
+        with scratch_tournament(scenario, collections) as tournament:
+            for name, seconds in bench_tournament(tournament, repeat=repeat).items():
+                results.append(dict(scenario=scenario, name=name, seconds=seconds))
+
+    # 赔率页面解析 (get_match_data 中除网络请求外的部分)
+    with open(os.path.join(TESTDATA_DIR, 'odds-20180715.html'), encoding='GBK') as f:
+        pages = {'odds-20180715': f.read()}
+    for parser, timings in bench_parser(pages, repeat=repeat).items():
+        for page, seconds in timings.items():
+            results.append(dict(scenario=page, name=f'parse_match_page:{parser}', seconds=seconds))
+    return results
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def load_results(path: str) -> List[dict]:
+    """读取保存的基准结果"""
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_results(path: str, results: List[dict], commit: str):
+    """以 json lines 追加保存本次结果 每条记录带 commit 及时间"""
+    created_at = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+    with open(path, 'a') as f:
+        for result in results:
+            f.write(json.dumps(dict(result, commit=commit, created_at=created_at)) + '\n')
+
+
+def previous_results(history: List[dict], commit: str) -> dict:
+    """其他 commit 最近一次的结果 {(scenario, name): seconds}"""
+    return {(r['scenario'], r['name']): r['seconds'] for r in history if r['commit'] != commit}
@@ -1,10 +1,14 @@
 import bson.json_util
 import click
+import glob
+import json
+import os
+import pymongo
 from flask import g
 
-from worldcup import model
+from worldcup import bench, model
 from worldcup.app import app, dbclient, get_tournament
-from worldcup.match_getter import populate_and_update
+from worldcup.match_getter import PageCache, poll_matches as _poll_matches, populate_and_update
 
 
 @app.cli.command('add_auction')
@@ -31,9 +35,125 @@ def update_weight(db, match_id, new_weight):
 @app.cli.command('fetch_match')
 @click.argument('db')
 @click.option('--days', default=1, type=int, help='Fetch incoming matches in days.')
-def fetch_match(db, days):
+@click.option('--workers', default=None, type=int, help='Concurrent page fetches (default: one per day).')
+@click.option('--timeout', default=30, type=float, help='Overall deadline in seconds for fetching pages.')
+@click.option('--cache/--no-cache', default=True, help='Skip pages and matches unchanged since the last fetch.')
+@click.option('--replay', is_flag=True, help='Read pages from the page cache only, without network requests.')
+def fetch_match(db, days, workers, timeout, cache, replay):
     g.tournament = get_tournament(db)
-    populate_and_update(g.tournament.league, g.tournament.weight_schedule, k=days)
+    cache = PageCache(app.config['MATCH_PAGE_CACHE_DIR']) if (cache or replay) else None
+    result = populate_and_update(g.tournament.league, g.tournament.weight_schedule, k=days, workers=workers,
+                                 timeout=timeout, cache=cache, replay=replay)
+    print(f'✅ fetch_match: {result.inserted} inserted, {result.updated} updated, {result.unchanged} unchanged')
+
+
+@app.cli.command('bench_parser')
+@click.argument('pages', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--repeat', default=5, type=int, help='Runs per page, the fastest one is reported.')
+def bench_parser(pages, repeat):
+    """比较各解析后端解析赔率页面的耗时及结果 默认使用 testdata 中保存的页面
+
+    pages 可以是 html 文件 (GBK) 或 PageCache 保存的 json 文件 (真实抓取的页面)
+    """
+    pages = pages or sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'testdata', 'odds-*.html')))
+    contents = {}
+    for path in pages:
+        if path.endswith('.json'):
+            with open(path, encoding='utf-8') as f:
+                contents[os.path.basename(path)] = json.load(f)['page']
+        else:
+            with open(path, encoding='GBK') as f:
+                contents[os.path.basename(path)] = f.read()
+    for parser, timings in bench.bench_parser(contents, repeat=repeat).items():
+        for name, seconds in timings.items():
+            print(f'{parser:>10} {name}: {seconds * 1000:.2f} ms')
+    mismatches = bench.compare_parsers(contents)
+    for name in mismatches:
+        print(f'❌ parsers disagree: {name}')
+    if mismatches:
+        raise SystemExit(1)
+    print(f'✅ parsers agree on {len(contents)} pages')
+
+
+@app.cli.command('bench')
+@click.option('--history/--no-history', default=True, help='Benchmark the tournaments saved in history/.')
+@click.option('--matches', default=10000, type=int, help='Matches of the synthetic tournament, 0 to skip it.')
+@click.option('--gamblers', default=500, type=int, help='Gamblers of the synthetic tournament.')
+@click.option('--repeat', default=3, type=int, help='Runs per benchmark, the fastest one is reported.')
+@click.option('--output', default=app.config['BENCH_RESULTS'], type=click.Path(dir_okay=False),
+              help='JSON lines file the results are appended to.')
+def bench_suite(history, matches, gamblers, repeat, output):
+    """运行性能基准 结果与其他 commit 的上一次结果对比后保存"""
+    scenarios = {}
+    if history:
+        for name in ('eurocup2016', 'worldcup2018'):
+            scenarios[name] = bench.history_tournament(name)
+    if matches:
+        scenarios[f'synthetic-{matches}x{gamblers}'] = bench.synthetic_tournament(matches=matches, gamblers=gamblers)
+
+    commit = bench.current_commit()
+    previous = bench.previous_results(bench.load_results(output), commit)
+    results = bench.bench_suite(scenarios, repeat=repeat)
+    for r in results:
+        line = f'{r["scenario"]:>24} {r["name"]:<32} {r["seconds"] * 1000:10.2f} ms'
+        before = previous.get((r['scenario'], r['name']))
+        if before:
+            line += f' ({r["seconds"] / before:.2f}x)'
+        print(line)
+    bench.save_results(output, results, commit)
+    print(f'✅ bench: {len(results)} results saved to {output} ({commit or "unknown commit"})')
+
+
+@app.cli.command('bench_match')
+@click.option('--count', default=50000, type=int, help='Number of synthetic matches.')
+@click.option('--repeat', default=3, type=int, help='Runs per method, the fastest one is reported.')
+def bench_match(count, repeat):
+    """比较 Match 构造方式的耗时及内存占用"""
+    docs = bench.synthetic_matches(count)
+    result = bench.bench_match(docs, repeat=repeat)
+    print(f'  __init__: {result["init"] * 1000:.1f} ms')
+    print(f'from_mongo: {result["from_mongo"] * 1000:.1f} ms')
+    print(f'    memory: {result["bytes"] / 2 ** 20:.1f} MiB ({result["bytes"] / count:.0f} B/match)'
+          f' / __dict__: {result["dict_bytes"] / 2 ** 20:.1f} MiB ({result["dict_bytes"] / count:.0f} B/match)')
+
+
+@app.cli.command('ensure_indexes')
+def ensure_indexes():
+    for name in model.ensure_indexes():
+        print(f'  {name}')
+    print('✅ ensure_indexes')
+
+
+@app.cli.command('rebuild_ledger')
+@click.argument('db')
+def rebuild_ledger(db):
+    g.tournament = get_tournament(db)
+    model.update_ledger()
+    print(f'✅ rebuild_ledger: {db}')
+
+
+@app.cli.command('poll_matches')
+@click.argument('db')
+@click.option('--days', default=1, type=int, help='Look for new matches in days.')
+@click.option('--once', is_flag=True, help='Poll once and exit.')
+def poll_matches(db, days, once):
+    g.tournament = get_tournament(db)
+    _poll_matches(g.tournament.league, g.tournament.weight_schedule, k=days,
+                  cache=PageCache(app.config['MATCH_PAGE_CACHE_DIR']), once=once)
+
+
+def _batches(lines, size):
+    """逐行解析 每 size 条记录返回一批"""
+    batch = []
+    for line in lines:
+        if not line.strip():
+            continue
+        batch.append(bson.json_util.loads(line))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 @app.cli.command('import_collection')
@@ -41,11 +161,44 @@ def fetch_match(db, days):
 @click.argument('collection')
 @click.argument('json', type=click.Path(exists=True, dir_okay=False, resolve_path=True))
 @click.option('--drop', default=True, type=bool, help='Drop existing collection before import.')
-def import_collection(db, collection, json, drop):
-    with open(json) as f:
-        data = [bson.json_util.loads(l) for l in f]
+@click.option('--upsert', 'upsert_key', default=None, help='Replace records matching on this field instead of dropping.')
+@click.option('--batch-size', default=1000, type=int, help='Records per insert round trip.')
+def import_collection(db, collection, json, drop, upsert_key, batch_size):
     ctl = dbclient[db][collection]
-    if drop:
+    if drop and not upsert_key:
         ctl.drop()
-    ctl.insert_many(data)
-    print(f'✅ import_collection: {ctl.full_name} ({ctl.find().count()} records)')
+    count = 0
+    # 逐批解析写入 内存占用与文件大小无关
+    with open(json) as f:
+        for batch in _batches(f, batch_size):
+            if upsert_key:
+                ctl.bulk_write([pymongo.ReplaceOne({upsert_key: d[upsert_key]}, d, upsert=True) for d in batch],
+                               ordered=False)
+            else:
+                ctl.insert_many(batch, ordered=False)
+            count += len(batch)
+            print(f'  {ctl.full_name}: {count} records', end='\r', flush=True)
+    print(f'✅ import_collection: {ctl.full_name} ({count} records)')
+    model.clear_caches()
+    # 导入 tournament 数据后重建 ledger
+    if any(t.dbname == db for t in app.config['TOURNAMENTS']) and collection in ('match', 'auction', 'gambler'):
+        g.tournament = get_tournament(db)
+        model.update_ledger()
+
+
+@app.cli.command('export_collection')
+@click.argument('db')
+@click.argument('collection')
+@click.argument('json', type=click.Path(dir_okay=False, writable=True, resolve_path=True))
+@click.option('--batch-size', default=1000, type=int, help='Records per cursor round trip.')
+def export_collection(db, collection, json, batch_size):
+    """导出为 history/ 下使用的格式 每行一条 bson.json_util 记录"""
+    ctl = dbclient[db][collection]
+    count = 0
+    with open(json, 'w') as f:
+        for d in ctl.find().sort('_id').batch_size(batch_size):
+            f.write(bson.json_util.dumps(d, json_options=bson.json_util.RELAXED_JSON_OPTIONS,
+                                         ensure_ascii=False, separators=(',', ':')))
+            f.write('\n')
+            count += 1
+    print(f'✅ export_collection: {ctl.full_name} ({count} records) -> {json}')
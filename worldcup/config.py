@@ -10,6 +10,7 @@ Tournament = namedtuple('Tournament', ['dbname', 'league', 'display', 'weight_sc
 
 SECRET_KEY = os.getenv('SECRET_KEY', 'super secret key')
 
+# mongodb://... 使用 MongoDB / memory:// 使用进程内存储 / sqlite:///path 使用进程内存储并保存到 SQLite 文件
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
 MONGO_LOGINDB = os.getenv('MONGO_LOGINDB', 'logins')
 
@@ -50,3 +51,41 @@ TOURNAMENTS = [
 DEFAULT_TOURNAMENT = TOURNAMENTS[-1]
 
 MAX_MATCH_DISPLAY = 20
+
+# 遍历全部比赛 (结算 / 重建 ledger) 时每批读取的比赛数
+MATCH_BATCH_SIZE = int(os.getenv('MATCH_BATCH_SIZE', 1000))
+
+# 投注先放入进程内队列 每 BET_QUEUE_INTERVAL 秒或累计 BET_QUEUE_BATCH 条时合并写入
+BET_QUEUE = os.getenv('BET_QUEUE', '') not in ('', '0', 'false')
+BET_QUEUE_INTERVAL = float(os.getenv('BET_QUEUE_INTERVAL', 0.5))
+BET_QUEUE_BATCH = int(os.getenv('BET_QUEUE_BATCH', 500))
+
+# 赔率页面解析后端 html5lib / lxml
+# lxml 快得多 切换前先用 flask bench_parser 在已抓取的真实页面 (MATCH_PAGE_CACHE_DIR) 上确认两者结果一致
+MATCH_PAGE_PARSER = os.getenv('MATCH_PAGE_PARSER', 'html5lib')
+
+# 已抓取赔率页面的缓存目录
+MATCH_PAGE_CACHE_DIR = os.getenv('MATCH_PAGE_CACHE_DIR', '/tmp/bet_web/pages')
+
+# 登录用户缓存 (openid -> user) 的容量及有效期 (秒)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 1024))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+# 未注册的 openid 只缓存很短时间 以免其他进程中刚注册的用户仍被要求注册
+USER_CACHE_MISS_TTL = int(os.getenv('USER_CACHE_MISS_TTL', 5))
+
+# 启动时检查索引是否齐全 (flask ensure_indexes 创建)
+CHECK_INDEXES = os.getenv('CHECK_INDEXES', '') not in ('', '0', 'false')
+
+# board 最多展示的比赛数 超出时降采样 (lttb / round) 0 为不限制
+BOARD_MAX_POINTS = int(os.getenv('BOARD_MAX_POINTS', 0))
+BOARD_DOWNSAMPLE = os.getenv('BOARD_DOWNSAMPLE', 'lttb')
+# 进程内最多缓存的 board 数据份数 (tournament / mode / points 各一份)
+BOARD_CACHE_SIZE = int(os.getenv('BOARD_CACHE_SIZE', 32))
+
+# flask bench 的结果文件 (json lines)
+BENCH_RESULTS = os.getenv('BENCH_RESULTS', 'bench-results.jsonl')
+
+# 每个请求的数据库命令统计 以 Server-Timing 响应头返回
+DB_SERVER_TIMING = os.getenv('DB_SERVER_TIMING', '') not in ('', '0', 'false')
+# 单个请求的数据库命令数上限 超出时记录 warning 0 为不检查
+DB_QUERY_BUDGET = int(os.getenv('DB_QUERY_BUDGET', 0))
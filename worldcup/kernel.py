@@ -0,0 +1,99 @@
+# coding: utf-8
+"""批量结算
+
+把一个 tournament 的全部比赛编码为数组 一次性算出所有玩家在所有比赛上的损益矩阵及累计积分
+
+逐元素的加减顺序与 Match.update_profit_and_loss_result 完全一致 因此结果与逐场结算逐位相同
+"""
+
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+
+class Settlement(NamedTuple):
+    gamblers: List[str]     # 矩阵行 前 len(required_gamblers) 行即参与结算的玩家
+    match_ids: List[str]    # 矩阵列 已有比分的比赛 按比赛时间排序
+    results: np.ndarray     # 每场损益 shape=(gamblers, matches)
+    totals: np.ndarray      # 累计积分 shape=(gamblers, matches)
+
+
+def settle(matches: list, required_gamblers: list, carry: Optional[np.ndarray] = None) -> Settlement:
+    """结算全部已有比分的比赛
+
+    分批结算时 carry 为上一批结束时 required_gamblers 的累计积分
+    """
+    matches = [m for m in sorted(matches, key=lambda m: m.match_time) if m.has_score()]
+
+    # 玩家编号 参与结算的玩家在前 其余投注者在后
+    gamblers = [str(gambler) for gambler in required_gamblers]
+    index = {name: i for i, name in enumerate(gamblers)}
+    for match in matches:
+        for name in match.a['gamblers'] + match.b['gamblers']:
+            if name not in index:
+                index[name] = len(gamblers)
+                gamblers.append(name)
+
+    n_gamblers, n_matches = len(gamblers), len(matches)
+
+    score_a = np.array([m.a['score'] for m in matches], dtype=float)
+    score_b = np.array([m.b['score'] for m in matches], dtype=float)
+    handicap = np.array([m.handicap for m in matches], dtype=float).reshape(n_matches, 2)
+    stack = np.array([m.weight / len(m.handicap) for m in matches], dtype=float)
+
+    # 投注矩阵
+    bet_a = np.zeros((n_gamblers, n_matches), dtype=bool)
+    bet_b = np.zeros((n_gamblers, n_matches), dtype=bool)
+    for j, match in enumerate(matches):
+        bet_a[[index[name] for name in match.a['gamblers']], j] = True
+        bet_b[[index[name] for name in match.b['gamblers']], j] = True
+
+    # team owner 编号 不参与结算的 owner 记为 -1
+    def _owner_index(side: dict) -> int:
+        return index.get(str(side['owner']), -1) if side['owner'] else -1
+
+    owner_a = np.array([_owner_index(m.a) for m in matches], dtype=int)
+    owner_b = np.array([_owner_index(m.b) for m in matches], dtype=int)
+
+    required = np.zeros(n_gamblers, dtype=bool)
+    required[:len(required_gamblers)] = True
+    punish = required[:, None] & ~bet_a & ~bet_b
+    count_a, count_b, count_punish = bet_a.sum(axis=0), bet_b.sum(axis=0), punish.sum(axis=0)
+
+    columns = np.arange(n_matches)
+    results = np.zeros((n_gamblers, n_matches))
+    for leg in range(2):
+        diff = score_b + handicap[:, leg]
+        a_wins, b_wins = score_a > diff, score_a < diff
+
+        winners = (bet_a & a_wins) | (bet_b & b_wins)
+        losers = (bet_b & a_wins) | (bet_a & b_wins)
+        count_winners = np.where(a_wins, count_a, np.where(b_wins, count_b, 0))
+        count_losers = np.where(a_wins, count_b, np.where(b_wins, count_a, 0))
+        reward_sum = stack * (count_losers + count_punish)
+        reward = np.divide(reward_sum, count_winners, out=np.zeros(n_matches), where=count_winners > 0)
+
+        # 未投注扣分 / 输家扣分 / 赢家加分
+        results += np.where(punish, -stack, 0.0)
+        results += np.where(losers, -stack, 0.0)
+        results += np.where(winners, reward, 0.0)
+
+        # 主队奖励
+        winner_owner = np.where(a_wins, owner_a, np.where(b_wins, owner_b, -1))
+        loser_owner = np.where(a_wins, owner_b, np.where(b_wins, owner_a, -1))
+        for owner, valid in ((winner_owner, winner_owner >= 0),
+                             (loser_owner, (loser_owner >= 0) & (loser_owner != winner_owner))):
+            bonus = np.zeros((n_gamblers, n_matches))
+            rows, cols = owner[valid], columns[valid]
+            hit = winners[rows, cols]
+            bonus[rows[hit], cols[hit]] = reward[cols[hit]]
+            results += bonus
+
+    # 逐场累加 (np.cumsum 为顺序累加) 与 Series.add_point 结果一致
+    # 上一批的累计积分作为首列参与累加 保证分批结算的加法顺序不变
+    start = np.zeros((n_gamblers, 1))
+    if carry is not None:
+        start[:len(required_gamblers), 0] = carry
+    totals = np.cumsum(np.hstack([start, results]), axis=1)[:, 1:]
+
+    return Settlement(gamblers=gamblers, match_ids=[m.id for m in matches], results=results, totals=totals)
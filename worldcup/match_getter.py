@@ -1,12 +1,40 @@
 import datetime
+import hashlib
+import json
 import logging
+import os
+import random
 import requests
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
-from worldcup.model import insert_match, update_match_score, update_match_handicap, utc_to_beijing
+from requests.adapters import HTTPAdapter
+from flask import g
+from worldcup import metrics
+from worldcup.app import app, tournamentdb
+from worldcup.config import MATCH_PAGE_PARSER
+from worldcup.model import Match, UpsertResult, ensure_ledger, find_unsettled_matches, upsert_matches, utc_to_beijing
 
+try:
+    import lxml.html
+except ImportError:     # 未安装 lxml 时只能使用 html5lib 解析
+    lxml = None
 
-def get_match_page(league, date, url='http://odds.sports.sina.com.cn/odds/index.php'):
+SINA_ODDS_URL = 'http://odds.sports.sina.com.cn/odds/index.php'
+
+
+def _backoff(attempt, base=0.2, cap=2.0):
+    """第 attempt 次重试前的等待时间 指数退避并加随机抖动"""
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def get_match_page(league, date, url=SINA_ODDS_URL, session=None, deadline=None, retry=5, timeout=1):
+    """获取某日赔率页面
+
+    :param session: 复用连接的 requests.Session 不指定则每次新建连接
+    :param deadline: time.monotonic() 截止时间 超时后不再重试
+    """
     form_data = {
         'date': '',
         'type': '1',
@@ -18,16 +46,18 @@ def get_match_page(league, date, url='http://odds.sports.sina.com.cn/odds/index.
 
     logging.info('Getting data from website: date="{}"'.format(date))
 
-    retry = 5
-    while retry:
+    get = session.get if session else requests.get
+    for attempt in range(retry):
         try:
-            r = requests.get(url, form_data, timeout=1)
+            r = get(url, params=form_data, timeout=timeout)
             break
         except Exception:
-            retry -= 1
-
-    if retry <= 0:
-        raise Exception("Request failed")
+            delay = _backoff(attempt)
+            if attempt == retry - 1 or (deadline and time.monotonic() + delay >= deadline):
+                raise Exception("Request failed")
+            metrics.SCRAPER_RETRIES.inc()
+            time.sleep(delay)
+    metrics.SCRAPER_PAGES.inc()
 
     r.encoding = 'GBK'
 
@@ -35,17 +65,18 @@ def get_match_page(league, date, url='http://odds.sports.sina.com.cn/odds/index.
     return r.text
 
 
-def parse_teams(team_str):
-    teams = team_str.findAll(text=True)
-    if len(teams) == 4:
-        return [teams[1][:-2], teams[3]]
+def parse_teams(texts):
+    """texts 为对阵单元格内的全部文本节点"""
+    if len(texts) == 4:
+        return [texts[1][:-2], texts[3]]
     else:
-        teams = teams[0].split('vs')
+        teams = texts[0].split('vs')
         return [teams[0], teams[1]]
 
 
-def parse_scores(score_str):
-    scores = score_str.find(text=True)
+def parse_scores(texts):
+    """texts 为比分单元格内的全部文本节点"""
+    scores = texts[0]
     if '-' not in scores:
         return ['', '']
     else:
@@ -53,10 +84,17 @@ def parse_scores(score_str):
         return [scores[0], scores[1]]
 
 
-def get_match_data(league, date):
-    result = list()
+def get_match_data(league, date, parser=None, **kwargs):
+    """获取并解析某日比赛 kwargs 传给 get_match_page()"""
+    return parse_match_page(get_match_page(league, date, **kwargs), date, parser=parser)
+
 
-    page = get_match_page(league, date)
+# 需要解析的列: 0 赛事 1 时间 2 对阵 3 主队水位 4 盘口 5 客队水位 15 比分
+MATCH_CELLS = (0, 1, 2, 3, 4, 5, 15)
+
+
+def _rows_html5lib(page):
+    """逐行返回 {列号: 文本节点列表}"""
     soup = BeautifulSoup(page, "html5lib")
     table = soup.find("table", {"class": "TableStyle"})
 
@@ -65,36 +103,76 @@ def get_match_data(league, date):
     for tbody in tbodies:
         for row in tbody.findAll("tr"):
             cells = row.findAll("td")
-            if not cells or cells[0].find(text=True) == '暂无数据':
-                continue
-            league_name = cells[0].find(text=True)
-            match_time_hhmm = cells[1].find(text=True)
-            teams = parse_teams(cells[2])
-            team_a = teams[0]
-            team_b = teams[1]
-            # ignore overtime, penalty shootout and other weird stuff
-            if ')' in team_a and ')' in team_b:
-                continue
-            premium_a = cells[3].find(text=True).replace(u'\xa0', u'')
-            handicap_display = cells[4].find(text=True).replace(u'\xa0', u'')
-            premium_b = cells[5].find(text=True).replace(u'\xa0', u'')
-            match_time = datetime.datetime.strptime(date.strftime("%Y%m%d") + " " + match_time_hhmm, "%Y%m%d %H:%M")
-            scores = parse_scores(cells[15])
-            score_a = scores[0]
-            score_b = scores[1]
-            match_entry = [league_name, match_time, handicap_display, team_a, team_b, premium_a, premium_b, score_a, score_b]
-            result.append(match_entry)
+            yield {i: cells[i].findAll(text=True) for i in MATCH_CELLS if i < len(cells)}
+
+
+def _rows_lxml(page):
+    """同 _rows_html5lib() 只生成所需列的文本"""
+    root = lxml.html.fromstring(page)
+    table = root.xpath('//table[contains(concat(" ", normalize-space(@class), " "), " TableStyle ")]')[0]
+
+    # ignore hidden rows
+    for tbody in table.xpath('.//tbody[not(@id)]'):
+        for row in tbody.xpath('.//tr'):
+            cells = row.xpath('.//td')
+            yield {i: [str(t) for t in cells[i].xpath('.//text()')] for i in MATCH_CELLS if i < len(cells)}
+
+
+PARSERS = {'html5lib': _rows_html5lib}
+if lxml:
+    PARSERS['lxml'] = _rows_lxml
+
+
+def parse_match_page(page, date, parser=None):
+    """解析赔率页面
+
+    :param parser: 解析后端 html5lib / lxml 默认为 config.MATCH_PAGE_PARSER (未安装 lxml 时使用 html5lib)
+    """
+    parser = parser or MATCH_PAGE_PARSER
+    if parser not in PARSERS:
+        parser = 'html5lib'
+    with metrics.SCRAPER_PARSE.time(parser=parser):
+        return _parse_rows(PARSERS[parser](page), date)
+
+
+def _parse_rows(rows, date):
+    result = list()
+    for cells in rows:
+        # 空行 / 首列为空 / 当日无比赛
+        if not cells or not cells[0] or cells[0][0] == '暂无数据':
+            continue
+        league_name = cells[0][0]
+        match_time_hhmm = cells[1][0]
+        teams = parse_teams(cells[2])
+        team_a = teams[0]
+        team_b = teams[1]
+        # ignore overtime, penalty shootout and other weird stuff
+        if ')' in team_a and ')' in team_b:
+            continue
+        premium_a = cells[3][0].replace(u'\xa0', u'')
+        handicap_display = cells[4][0].replace(u'\xa0', u'')
+        premium_b = cells[5][0].replace(u'\xa0', u'')
+        match_time = datetime.datetime.strptime(date.strftime("%Y%m%d") + " " + match_time_hhmm, "%Y%m%d %H:%M")
+        scores = parse_scores(cells[15])
+        score_a = scores[0]
+        score_b = scores[1]
+        match_entry = [league_name, match_time, handicap_display, team_a, team_b, premium_a, premium_b, score_a, score_b]
+        result.append(match_entry)
     return result
 
 
-def populate_match(league, weight_schedule, date):
+def populate_match(league, weight_schedule, date, matches=None) -> UpsertResult:
+    """写入某日比赛 matches 为已获取的比赛数据 不指定则现场获取"""
     utcnow = datetime.datetime.utcnow()
     log_file_name = utcnow.strftime('/tmp/bet_web/%y-%m-%d-MatchGetter.log')
+    os.makedirs(os.path.dirname(log_file_name), exist_ok=True)
     logging.basicConfig(filename=log_file_name, level=logging.INFO, format='%(asctime)s %(message)s')
-    matches = get_match_data(league, date)
+    if matches is None:
+        matches = get_match_data(league, date)
 
     logging.info('Matches collected: date="{}" league={} count={}'.format(date, league, len(matches)))
 
+    rows = []
     for league, match_time, handicap_display, team_a, team_b, premium_a, premium_b, score_a, score_b in matches:
         # 从tournament的weight_schedule里取得对应权重
         weight = 2
@@ -103,20 +181,229 @@ def populate_match(league, weight_schedule, date):
                 weight = w
                 break
 
-        match = insert_match(league, match_time, handicap_display, team_a, team_b, premium_a, premium_b, score_a, score_b, weight)
-        update_match_handicap(match_id=match.id, handicap_display=handicap_display)
-        update_match_score(match_id=match.id, score_a=score_a, score_b=score_b)
-    return
+        rows.append(Match(league, match_time, handicap_display, team_a, team_b, premium_a, premium_b, score_a, score_b, weight))
+
+    # 一天的比赛以一次 bulk_write 写入
+    return upsert_matches(rows)
 
 
-def populate_and_update(league, weight_schedule, k=1, current_date=None):
+def fetch_match_pages(league, dates, workers=None, timeout=30, url=SINA_ODDS_URL, errors=None):
+    """并发获取多日页面 共用一个 keep-alive session
+
+    :param workers: 并发数 默认每天一个线程
+    :param timeout: 整体截止时间 (秒)
+    :param errors: 指定时获取失败的日期以 (date, exception) 追加到其中 不抛出
+        不指定时等全部日期结束后抛出第一个异常
+    :return: [(date, page)] 按 dates 顺序 不含获取失败的日期
+    """
+    if not dates:
+        return []
+    workers = max(1, workers or len(dates))
+    deadline = time.monotonic() + timeout
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(get_match_page, league, date, url=url, session=session, deadline=deadline)
+                       for date in dates]
+            pages, failures = [], []
+            for date, future in zip(dates, futures):
+                try:
+                    pages.append((date, future.result(timeout=max(deadline - time.monotonic(), 0))))
+                except Exception as e:
+                    failures.append((date, e))
+    if errors is None and failures:
+        raise failures[0][1]
+    if errors is not None:
+        errors.extend(failures)
+    return pages
+
+
+def fetch_match_data(league, dates, **kwargs):
+    """并发获取并解析多日比赛 kwargs 传给 fetch_match_pages()
+
+    :return: [(date, matches)] 按 dates 顺序
+    """
+    return [(date, parse_match_page(page, date)) for date, page in fetch_match_pages(league, dates, **kwargs)]
+
+
+class PageCache:
+    """已抓取页面的磁盘缓存
+
+    以 (tournament, league, date) 为 key 保存页面内容 内容摘要及每行比赛的摘要
+    页面未变化时跳过解析 行未变化时跳过写入
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, league, date):
+        return os.path.join(self.root, tournamentdb.name, '{}-{}.json'.format(league, date.strftime('%Y%m%d')))
+
+    def load(self, league, date) -> dict:
+        try:
+            with open(self._path(league, date), encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, league, date, page, rows):
+        path = self._path(league, date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再替换 避免中断时留下损坏的缓存
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(dict(hash=digest(page), page=page, rows=rows), f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+
+def digest(content) -> str:
+    return hashlib.sha1(str(content).encode('utf-8')).hexdigest()
+
+
+def _row_id(match_entry) -> str:
+    """行摘要的 key 与比赛 id 相同 (比赛时间 + 队名)"""
+    _, match_time, _, team_a, team_b, *_ = match_entry
+    return '{:%Y%m%d%H%M}-{}-{}'.format(match_time, team_a, team_b)
+
+
+def populate_page(league, weight_schedule, date, page, cache=None, replay=False) -> UpsertResult:
+    """解析页面并写入比赛 有 cache 时跳过未变化的页面及比赛"""
+    cached = cache.load(league, date) if cache else {}
+    unchanged = not replay and cached.get('hash') == digest(page)
+    if cache:
+        metrics.cache_lookup('page', unchanged)
+    if unchanged:
+        logging.info('Page unchanged: date="{}" league={}'.format(date, league))
+        return UpsertResult(0, 0, len(cached['rows']))
+
+    matches = parse_match_page(page, date)
+    rows = {_row_id(m): digest(m) for m in matches}
+    cached_rows = {} if replay else cached.get('rows', {})
+    changed = [m for m in matches if cached_rows.get(_row_id(m)) != digest(m)]
+
+    result = populate_match(league, weight_schedule, date, matches=changed)
+    if cache and not replay:
+        cache.save(league, date, page, rows)
+    return UpsertResult(result.inserted, result.updated, result.unchanged + len(matches) - len(changed))
+
+
+def populate_and_update(league, weight_schedule, k=1, current_date=None, workers=None, timeout=30, url=SINA_ODDS_URL,
+                        cache=None, replay=False):
     """
     :param league: league filter
     :param current_date: the date from which getter starts
     :param k: get match data within k days
-    :return:
+    :param workers: concurrent page fetches, 1 for serial fetching
+    :param timeout: overall deadline in seconds for fetching all pages
+    :param cache: PageCache to skip unchanged pages and rows
+    :param replay: read pages from cache only, without network requests
+    :return: inserted / updated / unchanged match counts
     """
     current_date = current_date or utc_to_beijing(datetime.datetime.utcnow())
-    for day_diff in range(-1, k + 1):
-        populate_match(league, weight_schedule, date=current_date + datetime.timedelta(days=day_diff))
-    return
+    dates = [current_date + datetime.timedelta(days=day_diff) for day_diff in range(-1, k + 1)]
+    return populate_dates(league, weight_schedule, dates, workers=workers, timeout=timeout, url=url,
+                          cache=cache, replay=replay)
+
+
+def populate_dates(league, weight_schedule, dates, workers=None, timeout=30, url=SINA_ODDS_URL, cache=None, replay=False):
+    """抓取并写入指定日期的比赛 参数同 populate_and_update()
+
+    部分日期获取失败时仍写入其他日期 之后抛出第一个异常
+    """
+    if not dates:
+        return UpsertResult(0, 0, 0)
+    errors = []
+    if replay:
+        pages = [(date, cache.load(league, date).get('page')) for date in dates]
+    else:
+        pages = fetch_match_pages(league, dates, workers=workers, timeout=timeout, url=url, errors=errors)
+
+    total = UpsertResult(0, 0, 0)
+    # 网络请求并发执行 数据库写入仍在当前线程 (app context) 中依次进行
+    for date, page in pages:
+        if page is None:
+            logging.info('Page not cached: date="{}" league={}'.format(date, league))
+            continue
+        result = populate_page(league, weight_schedule, date, page, cache=cache, replay=replay)
+        total = UpsertResult(*[x + y for x, y in zip(total, result)])
+    for name, count in total._asdict().items():
+        metrics.SCRAPER_ROWS.inc(count, result=name)
+    for date, e in errors:
+        logging.error('Page fetch failed: date="{}" league={} error={!r}'.format(date, league, e))
+    if errors:
+        raise errors[0][1]
+    return total
+
+
+# 轮询间隔
+POLL_LIVE = datetime.timedelta(minutes=2)           # 比赛进行中
+POLL_NEAR = datetime.timedelta(minutes=5)           # 临近开赛或盘口截止
+POLL_PENDING = datetime.timedelta(minutes=15)       # 比赛已结束但仍无比分
+POLL_IDLE = datetime.timedelta(minutes=60)          # 其他情况 同时抓取未来几天以发现新比赛
+
+MATCH_DURATION = datetime.timedelta(hours=3)        # 含加时及点球
+NEAR_WINDOW = datetime.timedelta(minutes=30)
+
+
+def poll_plan(matches, now):
+    """根据未结算比赛决定本轮需要抓取的日期及下次轮询的间隔
+
+    :param matches: 未结算的比赛
+    :param now: 当前北京时间
+    :return: (dates, interval)
+    """
+    dates, interval = set(), POLL_IDLE
+    for match in matches:
+        if match.match_time <= now < match.match_time + MATCH_DURATION:
+            wait = POLL_LIVE
+        elif (now <= match.match_time <= now + NEAR_WINDOW
+              or now <= match.handicap_cutoff_time <= now + NEAR_WINDOW):
+            wait = POLL_NEAR
+        elif match.match_time + MATCH_DURATION <= now:
+            wait = POLL_PENDING
+        else:
+            # 开赛或盘口截止还早 在其进入 NEAR_WINDOW 时再轮询
+            event = min(t for t in (match.handicap_cutoff_time, match.match_time) if t > now + NEAR_WINDOW)
+            interval = min(interval, max(POLL_NEAR, event - NEAR_WINDOW - now))
+            continue
+        dates.add(match.match_time.date())
+        interval = min(interval, wait)
+    return sorted(dates), interval
+
+
+def poll_matches(league, weight_schedule, k=1, cache=None, once=False, **kwargs):
+    """持续轮询 只抓取有未结算比赛的日期 每隔 POLL_IDLE 抓取一次前一天至未来 k 天以发现新比赛
+
+    kwargs 传给 populate_dates()
+    """
+    tournament = g.tournament
+    last_full = None
+    while True:
+        now = utc_to_beijing(datetime.datetime.utcnow())
+        # 每轮使用新的 app context 以免长期持有过期的 owner 缓存
+        with app.app_context():
+            g.tournament = tournament
+            interval, last_full = _poll_once(league, weight_schedule, k, now, last_full, cache, **kwargs)
+        if once:
+            return
+        time.sleep(interval.total_seconds())
+
+
+def _poll_once(league, weight_schedule, k, now, last_full, cache, **kwargs):
+    """轮询一次 返回 (下次轮询间隔, 上次全量抓取时间)"""
+    try:
+        dates, interval = poll_plan(find_unsettled_matches(after=now - datetime.timedelta(days=2)), now)
+        if last_full is None or now - last_full >= POLL_IDLE:
+            dates = sorted(set(dates) | {(now + datetime.timedelta(days=d)).date() for d in range(-1, k + 1)})
+            last_full = now
+        result = populate_dates(league, weight_schedule, [datetime.datetime.combine(d, datetime.time()) for d in dates],
+                                cache=cache, **kwargs)
+        # 新玩家加入后 ledger 在此重建 不占用 web 请求
+        ensure_ledger()
+        logging.info('Polled: dates={} result={} next={}'.format(dates, result, interval))
+    except Exception:
+        # 保持常驻 稍后重试
+        logging.exception('Poll failed')
+        interval = POLL_NEAR
+    return interval, last_full
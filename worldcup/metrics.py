@@ -0,0 +1,167 @@
+# coding: utf-8
+"""运行指标
+
+进程内的 Counter / Histogram 由 /metrics 以 Prometheus 文本格式输出
+多进程部署时每个进程各自统计 由 Prometheus 汇总
+"""
+
+import contextlib
+import threading
+import time
+from typing import List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}   # {label values: 值}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} expects labels {}, got {}'.format(self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, List[Tuple[str, str]], float]]:
+        """[(name, labels, value)]"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        lines.extend('{}{} {}'.format(name, _format_labels(labels), _format_value(value))
+                     for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, list(zip(self.labelnames, key)), value) for key, value in values]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """记录代码块的耗时 (秒) 也可用作函数装饰器"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels) -> Tuple[int, float]:
+        """(count, sum)"""
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            return counts[-1], total
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            labels = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                samples.append((self.name + '_bucket', labels + [('le', _format_value(bound))], count))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, counts[-1]))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        return ''.join(metric.render() + '\n' for metric in self._metrics)
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames=()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# 请求
+REQUEST_DURATION = histogram('bet_web_request_duration_seconds', 'Request latency by endpoint.', ['endpoint'])
+
+# 结算
+SETTLEMENT_DURATION = histogram('bet_web_settlement_duration_seconds',
+                                'Duration of generate_series and ledger updates.', ['operation'])
+
+# 缓存 命中率为 hit / (hit + miss)
+CACHE_REQUESTS = counter('bet_web_cache_requests_total', 'Cache lookups by cache and result (hit / miss).',
+                         ['cache', 'result'])
+
+# 抓取
+SCRAPER_PAGES = counter('bet_web_scraper_pages_fetched_total', 'Odds pages fetched.')
+SCRAPER_RETRIES = counter('bet_web_scraper_retries_total', 'Odds page request retries.')
+SCRAPER_PARSE = histogram('bet_web_scraper_parse_seconds', 'Odds page parse time.', ['parser'],
+                          buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+SCRAPER_ROWS = counter('bet_web_scraper_rows_total', 'Match rows written by the scraper by result.', ['result'])
+
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
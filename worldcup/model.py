@@ -1,21 +1,94 @@
 # coding: utf-8
 
+import atexit
+import bson
+import contextlib
 import datetime
+import itertools
 import logging
 import pymongo
+import pymongo.errors
+import threading
+import time
 
 from collections import namedtuple, OrderedDict, UserString
-from typing import List, Optional, Union
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 
-from .app import logindb, tournamentdb, dbclient
-from .config import TOURNAMENTS
+from flask import g
+
+from . import metrics
+from .app import app, get_tournament, logindb, tournamentdb, dbclient
+from .config import (BET_QUEUE_BATCH, BET_QUEUE_INTERVAL, MATCH_BATCH_SIZE, TOURNAMENTS,
+                     USER_CACHE_MISS_TTL, USER_CACHE_SIZE, USER_CACHE_TTL)
 from .constant import HANDICAP_DICT
 
+try:
+    from . import kernel
+except ImportError:     # 未安装 numpy 时逐场结算
+    kernel = None
+
 
 def utc_to_beijing(utc_time: datetime.datetime) -> datetime.datetime:
     return utc_time + datetime.timedelta(hours=8)
 
 
+class TTLCache:
+    """进程内 LRU 缓存 每条记录 ttl 秒后过期
+
+    多进程部署时其他进程的写入最多延迟 ttl 秒可见
+    """
+
+    _missing = object()
+
+    def __init__(self, maxsize: int, ttl: float, name: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name    # 指定时统计命中率 (metrics.CACHE_REQUESTS)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=_missing):
+        """返回缓存值 未命中时返回 TTLCache._missing"""
+        with self._lock:
+            item = self._data.get(key)
+            hit = item is not None and item[0] >= time.monotonic()
+            if self.name:
+                metrics.cache_lookup(self.name, hit)
+            if not hit:
+                self._data.pop(key, None)
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl: float = None):
+        """ttl 默认为 self.ttl"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# openid -> Optional[User] 未知 openid 也缓存 (None) 但只保留 USER_CACHE_MISS_TTL 秒
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, name='user')
+
+
+def clear_caches():
+    """清除进程内缓存 直接修改数据库 (如导入数据) 后使用"""
+    _user_cache.clear()
+    _known_gamblers.clear()
+
+
 # class User:
 #     name = "user's name"
 #     openid = 'wechat openid'
@@ -37,6 +110,7 @@ def insert_user(name: str, openid: str) -> User:
     user = User(name=name, openid=openid)
     # 用 replace_one(upsert=True) 避免插入重复记录
     logindb.user.replace_one({'openid': openid}, user._asdict(), upsert=True)
+    _user_cache.pop(openid)
     return user
 
 
@@ -47,6 +121,7 @@ def drop_user(ident: str):
         return
     # login
     logindb.user.delete_one({'name': user.name, 'openid': user.openid})
+    _user_cache.pop(user.openid)
     # 不删除 match / auction / gambler 以免丢失历史数据
 
 
@@ -54,6 +129,9 @@ def update_user_name(current: str, new: str):
     """重命名 user"""
     # login
     logindb.user.update_one({'name': current}, {'$set': {'name': new}})
+    _user_cache.clear()
+    # auction 改名后各 tournament 的 owner 缓存均失效
+    _invalidate_team_owners(all_tournaments=True)
     for tournament in TOURNAMENTS:
         # match
         dbclient[tournament.dbname].match.update_many({'a.gamblers': current}, {'$set': {'a.gamblers.$': new}})
@@ -62,6 +140,12 @@ def update_user_name(current: str, new: str):
         dbclient[tournament.dbname].auction.update_many({'gambler': current}, {'$set': {'gambler': new}})
         # gambler
         dbclient[tournament.dbname].gambler.update_many({'name': current}, {'$set': {'name': new}})
+        # 旧名字可能被新用户使用 须重新报名
+        _known_gamblers.get(tournament.dbname, set()).difference_update({current, new})
+        # ledger
+        dbclient[tournament.dbname].ledger.update_many(
+            {}, {'$set': {'result.$[e].name': new, 'totals.$[e].name': new}}, array_filters=[{'e.name': current}])
+        bump_version(dbclient[tournament.dbname])
 
 
 def find_user_by_name(name: str) -> Optional[User]:
@@ -73,11 +157,14 @@ def find_user_by_name(name: str) -> Optional[User]:
 
 
 def find_user_by_openid(openid: str) -> Optional[User]:
-    """根据 openid 获取 user"""
+    """根据 openid 获取 user 结果缓存在进程内"""
+    user = _user_cache.get(openid)
+    if user is not TTLCache._missing:
+        return user
     d = logindb.user.find_one({'openid': openid})
-    if not d:
-        return
-    return User(name=d['name'], openid=d['openid'])
+    user = User(name=d['name'], openid=d['openid']) if d else None
+    _user_cache.set(openid, user, ttl=None if user else USER_CACHE_MISS_TTL)
+    return user
 
 
 # class Gambler:
@@ -100,10 +187,27 @@ def insert_gambler(g: Union[UserString, str]) -> Gambler:
     """插入若干个 gambler"""
     gambler = Gambler(g)
     # 用 replace_one(upsert=True) 避免插入重复记录
-    tournamentdb.gambler.replace_one({'name': gambler.name}, gambler._asdict(), upsert=True)
+    r = tournamentdb.gambler.replace_one({'name': gambler.name}, gambler._asdict(), upsert=True)
+    # 新玩家加入后 未投注惩罚涉及全部已结算比赛 须重建 ledger
+    # 重建耗时较长 不在当前请求中进行 只标记过期
+    if r.upserted_id is not None:
+        invalidate_ledger()
     return gambler
 
 
+# 本进程已确认报名的玩家 {dbname: {name}}
+_known_gamblers = {}
+
+
+def _register_gambler(g: Union[UserString, str]):
+    """报名本次赛事 同一进程内每个玩家只写入一次"""
+    known = _known_gamblers.setdefault(tournamentdb.name, set())
+    if str(g) in known:
+        return
+    insert_gambler(g)
+    known.add(str(g))
+
+
 def find_gamblers() -> List[Gambler]:
     """获取本次 tournament 全部 gambler"""
     return [Gambler(d['name']) for d in tournamentdb.gambler.find()]
@@ -121,6 +225,11 @@ def insert_auction(team: str, gambler: Gambler, price: int) -> Auction:
     """插入拍卖记录"""
     auction = Auction(team=team, gambler=str(gambler), price=price)
     tournamentdb.auction.replace_one({'team': team}, auction._asdict(), upsert=True)
+    _invalidate_team_owners()
+    # 重新结算该队参与的比赛 尚无比赛 (拍卖时通常如此) 时无需更新
+    match_ids = [m['id'] for m in tournamentdb.match.find({'$or': [{'a.team': team}, {'b.team': team}]}, {'id': 1})]
+    if match_ids:
+        update_ledger(*match_ids)
     return auction
 
 
@@ -132,10 +241,34 @@ def find_auction(team: str) -> Optional[Auction]:
     return Auction(team=a['team'], gambler=a['gambler'], price=a['price'])
 
 
+def _team_owners() -> dict:
+    """当前 tournament 的 team -> owner (Gambler) 映射
+
+    在 app context (即单次请求或单条 CLI 命令) 内只查询一次 auction 集合
+    """
+    owners = g.setdefault('_team_owners', {})
+    dbname = tournamentdb.name
+    metrics.cache_lookup('team_owner', dbname in owners)
+    if dbname not in owners:
+        owners[dbname] = {a['team']: Gambler(a['gambler'])
+                          for a in tournamentdb.auction.find({}, {'team': 1, 'gambler': 1})}
+    return owners[dbname]
+
+
+def _invalidate_team_owners(all_tournaments=False):
+    """auction 变化后清除 owner 缓存"""
+    owners = g.get('_team_owners')
+    if not owners:
+        return
+    if all_tournaments:
+        owners.clear()
+    else:
+        owners.pop(tournamentdb.name, None)
+
+
 def find_team_owner(team: str) -> Optional[Gambler]:
     """根据拍卖记录查找 team owner"""
-    a = find_auction(team)
-    return Gambler(a.gambler) if a else None
+    return _team_owners().get(team)
 
 
 # class Match
@@ -158,8 +291,43 @@ def find_team_owner(team: str) -> Optional[Gambler]:
 #     handicap = (None, None)
 #     weight = None
 
+class Side:
+    """比赛一方 兼容 dict 的下标访问 (side['team'])"""
+
+    __slots__ = ('team', 'premium', 'score', 'gamblers', 'owner')
+
+    def __init__(self, team, premium, score, gamblers, owner):
+        self.team = team
+        self.premium = premium
+        self.score = score
+        self.gamblers = gamblers
+        self.owner = owner
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def __eq__(self, other):
+        return isinstance(other, Side) and all(self[k] == other[k] for k in self.__slots__)
+
+    def __repr__(self):
+        return 'Side({})'.format(', '.join('{}={!r}'.format(k, self[k]) for k in self.__slots__))
+
+
 class Match:
 
+    __slots__ = ('league', 'match_time', 'handicap_display', 'handicap', 'a', 'b', 'weight', 'id', '_result')
+
     def __init__(self, league, match_time, handicap_display,
                  team_a, team_b, premium_a, premium_b, score_a, score_b,
                  weight=2, id=None):
@@ -176,14 +344,14 @@ class Match:
             score_a = None
             score_b = None
 
-        self.a = dict(
+        self.a = Side(
             team=team_a,
             premium=float(premium_a),
             score=score_a,
             gamblers=[],
             owner=find_team_owner(team=team_a),
         )
-        self.b = dict(
+        self.b = Side(
             team=team_b,
             premium=float(premium_b),
             score=score_b,
@@ -200,16 +368,29 @@ class Match:
         return self._asdict() == other._asdict()
 
     @classmethod
-    def from_mongo(cls, m: dict):  # -> Optional[Match]
-        """根据 mongo 返回的 record 构造 Match 对象"""
+    def from_mongo(cls, m: dict, owners: Optional[dict] = None):  # -> Optional[Match]
+        """根据 mongo 返回的 record 构造 Match 对象
+
+        数据库中的记录由 Match._asdict() 写入 handicap / score / premium 已是规范值 直接使用 不再经过 __init__
+        owners 为 team -> owner 映射 默认使用 _team_owners()
+        """
         if not m:
             return
-        match = Match(league=m['league'], match_time=m['match_time'], handicap_display=m['handicap_display'],
-                      team_a=m['a']['team'], premium_a=m['a']['premium'], score_a=m['a']['score'],
-                      team_b=m['b']['team'], premium_b=m['b']['premium'], score_b=m['b']['score'],
-                      weight=m['weight'], id=m['id'])
-        match.a['gamblers'] = m['a']['gamblers']
-        match.b['gamblers'] = m['b']['gamblers']
+        if owners is None:
+            owners = _team_owners()
+        match = cls.__new__(cls)
+        match.league = m['league']
+        match.match_time = m['match_time']
+        match.handicap_display = m['handicap_display']
+        handicap = m.get('handicap')
+        match.handicap = tuple(handicap) if handicap else _generate_handicap_pair(m['handicap_display'])
+        match.a = Side(m['a']['team'], m['a']['premium'], m['a']['score'], m['a']['gamblers'],
+                       owners.get(m['a']['team']))
+        match.b = Side(m['b']['team'], m['b']['premium'], m['b']['score'], m['b']['gamblers'],
+                       owners.get(m['b']['team']))
+        match.weight = m['weight']
+        match.id = m['id']
+        match._result = None
         return match
 
     @property
@@ -289,13 +470,11 @@ class Match:
         # 相当于将本场比赛拆成 n 个小比赛进行结算
         stack = self.weight / len(self.handicap)
 
-        for handicap in self.handicap:
-            # 找出未投注玩家
-            punish_gamblers = []
-            for gambler in required_gamblers:
-                if gambler not in self.a['gamblers'] and gambler not in self.b['gamblers']:
-                    punish_gamblers.append(gambler)
+        # 找出未投注玩家
+        bettors = set(self.a['gamblers']) | set(self.b['gamblers'])
+        punish_gamblers = [gambler for gambler in required_gamblers if gambler not in bettors]
 
+        for handicap in self.handicap:
             # 未投注直接扣分
             for gambler in punish_gamblers:
                 self._result[gambler] -= stack
@@ -322,8 +501,8 @@ class Match:
                 self._result[gambler] += winner_reward
 
             # 主队奖励
-            winner_team_owner = find_team_owner(winner['team'])
-            loser_team_owner = find_team_owner(loser['team'])
+            winner_team_owner = winner['owner']
+            loser_team_owner = loser['owner']
             if winner_team_owner in winner['gamblers']:
                 self._result[winner_team_owner] += winner_reward
             if winner_team_owner != loser_team_owner and loser_team_owner in winner['gamblers']:
@@ -364,9 +543,55 @@ def insert_match(league, match_time, handicap_display, team_a, team_b, premium_a
     match = Match(league, match_time, handicap_display, team_a, team_b, premium_a, premium_b, score_a, score_b, weight)
     tournamentdb.match.insert_one(match._asdict())
     logging.info('New match: match={}'.format(match.id))
+    if match.has_score():
+        update_ledger(match.id)
     return match
 
 
+UpsertResult = namedtuple('UpsertResult', ['inserted', 'updated', 'unchanged'])
+
+
+def upsert_matches(matches: List[Match]) -> UpsertResult:
+    """以一次 bulk_write 批量写入比赛
+
+    与 insert_match + update_match_handicap + update_match_score 效果相同:
+    新比赛插入全部字段 已有比赛只更新比分及 (盘口截止前的) 盘口
+    """
+    if not matches:
+        return UpsertResult(0, 0, 0)
+
+    ops = []
+    for match in matches:
+        doc = match._asdict()
+        on_insert = {k: doc[k] for k in ('league', 'match_time', 'weight', 'id')}
+        for side in ('a', 'b'):
+            on_insert.update({f'{side}.{k}': doc[side][k] for k in ('team', 'premium', 'gamblers')})
+        to_set = {}
+
+        # id 包含比赛时间 已有比赛的盘口截止时间与此相同
+        handicap = {'handicap': doc['handicap'], 'handicap_display': doc['handicap_display']}
+        (to_set if match.can_update_handicap() else on_insert).update(handicap)
+
+        score = {'a.score': doc['a']['score'], 'b.score': doc['b']['score']}
+        (to_set if match.has_score() else on_insert).update(score)
+
+        update = {'$setOnInsert': on_insert}
+        if to_set:
+            update['$set'] = to_set
+        ops.append(pymongo.UpdateOne({'id': match.id}, update, upsert=True))
+
+    r = tournamentdb.match.bulk_write(ops, ordered=False)
+    result = UpsertResult(inserted=r.upserted_count, updated=r.modified_count,
+                          unchanged=len(matches) - r.upserted_count - r.modified_count)
+    logging.info('Matches upserted: inserted={} updated={} unchanged={}'.format(*result))
+
+    # 有比分的比赛可能变化 重新结算
+    scored = [m.id for m in matches if m.has_score()]
+    if scored and (result.inserted or result.updated):
+        update_ledger(*scored)
+    return result
+
+
 def update_match_score(match_id: str, score_a: str, score_b: str):
     """更新比分"""
     try:
@@ -379,6 +604,7 @@ def update_match_score(match_id: str, score_a: str, score_b: str):
         {"$set": {"a.score": score_a, "b.score": score_b}}
     )
     logging.info('Score updated: match={} score="{}:{}"'.format(match_id, score_a, score_b))
+    update_ledger(match_id)
 
 
 def update_match_handicap(match_id: str, handicap_display: str, cutoff_check=True):
@@ -392,14 +618,23 @@ def update_match_handicap(match_id: str, handicap_display: str, cutoff_check=Tru
         {"$set": {"handicap": _generate_handicap_pair(handicap_display), "handicap_display": handicap_display}}
     )
     logging.info('Handicap updated: match={} handicap="{}"'.format(match_id, handicap_display))
+    update_ledger(match_id)
 
 
-def update_match_gamblers(match_id: str, team: str, gambler: Union[Gambler, User], cutoff_check=True):
-    """更新投注结果"""
-    match = find_match_by_id(match_id)
-    # 若比赛不存在或当前非投注时间则直接返回
-    if not match or (cutoff_check and not match.can_bet()):
-        return
+def _bet_window(now: datetime.datetime) -> dict:
+    """投注时间 (Match.can_bet) 对应的 match_time 查询条件
+
+    can_bet() 即 handicap_cutoff_time < now <= match_time
+    handicap_cutoff_time 为 match_time 之前最近的 12:00 它早于 now 等价于 match_time 不晚于 now 之后 (含) 最近的 12:00
+    """
+    noon = now.replace(hour=12, minute=0, second=0, microsecond=0)
+    if noon < now:
+        noon += datetime.timedelta(days=1)
+    return {'$gte': now, '$lte': noon}
+
+
+def _bet_update(team: str, name: str) -> dict:
+    """投注 team 对应的 gamblers 列表更新"""
     # 判断投注情况
     if team == 'a':
         # 投 a 队
@@ -410,10 +645,140 @@ def update_match_gamblers(match_id: str, team: str, gambler: Union[Gambler, User
     else:
         # 除 a / b 以外则报错
         raise ValueError(f'Expect team to be: a or b, but got: {team}')
+    return {"$pull": {out: name}, "$addToSet": {in_: name}}
+
+
+def update_match_gamblers(match_id: str, team: str, gambler: Union[Gambler, User], cutoff_check=True) -> bool:
+    """更新投注结果 返回投注是否成功
+
+    投注时间的检查包含在 update_one 的查询条件中 一次写入即完成投注
+    """
+    update = _bet_update(team, gambler.name)
+    # 若比赛不存在或当前非投注时间则不更新
+    query = {"id": match_id}
+    if cutoff_check:
+        query["match_time"] = _bet_window(utc_to_beijing(datetime.datetime.utcnow()))
     # 更新 a / b 的 gamblers 列表
-    tournamentdb.match.update_one({"id": match_id}, {"$pull": {out: gambler.name}, "$addToSet": {in_: gambler.name}})
+    r = tournamentdb.match.update_one(query, update)
+    if not r.matched_count:
+        return False
+    # 投注时间内比赛尚未开始 没有比分 无需结算
+    if not cutoff_check:
+        update_ledger(match_id)
     # 投注成功视作报名本次赛事
-    insert_gambler(gambler)
+    _register_gambler(gambler)
+    return True
+
+
+class BetQueue:
+    """投注写入队列
+
+    开赛前集中投注时 请求只把投注放入队列 由后台线程每 interval 秒合并写入一次
+    同一玩家对同一场比赛的多次投注只保留最后一次
+    投注时间以请求时刻为准 (写入时按该时刻的 _bet_window 过滤) 写入延迟不会让开赛前的投注失效
+    """
+
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        # {(dbname, match_id, name): (team, 投注时刻)}
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def submit(self, match_id: str, team: str, gambler: Union[Gambler, User]):
+        """投注放入队列"""
+        _bet_update(team, gambler.name)  # 检查 team
+        key = (tournamentdb.name, match_id, gambler.name)
+        with self._lock:
+            self._pending.pop(key, None)
+            self._pending[key] = (team, utc_to_beijing(datetime.datetime.utcnow()))
+            size = len(self._pending)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='bet-queue', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        if size >= self.batch_size:
+            self._wake.set()
+
+    def pending(self) -> dict:
+        """本次 tournament 尚未写入的投注 {(match_id, name): team}"""
+        dbname = tournamentdb.name
+        with self._lock:
+            return {(match_id, name): team for (db, match_id, name), (team, _) in self._pending.items() if db == dbname}
+
+    def apply(self, matches: List['Match']) -> List['Match']:
+        """把尚未写入的投注叠加到 matches 上 用于展示"""
+        pending = self.pending()
+        if not pending:
+            return matches
+        for match in matches:
+            for (match_id, name), team in pending.items():
+                if match_id != match.id or not match.can_bet():
+                    continue
+                in_, out = (match.a, match.b) if team == 'a' else (match.b, match.a)
+                if name in out['gamblers']:
+                    out['gamblers'].remove(name)
+                if name not in in_['gamblers']:
+                    in_['gamblers'].append(name)
+        return matches
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Bet queue flush failed')
+
+    def flush(self) -> int:
+        """写入队列中的全部投注 返回写入成功的投注数"""
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        by_db = {}
+        for (dbname, match_id, name), bet in pending.items():
+            by_db.setdefault(dbname, {})[(match_id, name)] = bet
+        accepted, failed = 0, []
+        # 各 tournament 分别写入 一个失败不影响其他
+        for dbname, bets in by_db.items():
+            try:
+                accepted += self._flush_tournament(dbname, bets)
+            except Exception as e:
+                # 写入失败的投注放回队列 (已有更新投注的除外) 下次重试
+                with self._lock:
+                    for (match_id, name), bet in bets.items():
+                        self._pending.setdefault((dbname, match_id, name), bet)
+                failed.append((dbname, e))
+        if failed:
+            raise RuntimeError('Bet queue flush failed: {}'.format(
+                ', '.join('{}: {!r}'.format(dbname, e) for dbname, e in failed))) from failed[0][1]
+        return accepted
+
+    @staticmethod
+    def _flush_tournament(dbname: str, bets: dict) -> int:
+        with app.app_context():
+            g.tournament = get_tournament(dbname)
+            r = tournamentdb.match.bulk_write([
+                pymongo.UpdateOne({'id': match_id, 'match_time': _bet_window(at)}, _bet_update(team, name))
+                for (match_id, name), (team, at) in bets.items()
+            ], ordered=False)
+            # 投注成功视作报名本次赛事 比赛时间之外被拒绝的投注不算
+            match_ids = list({match_id for match_id, _ in bets})
+            placed = set()
+            for d in tournamentdb.match.find({'id': {'$in': match_ids}}, {'id': 1, 'a.gamblers': 1, 'b.gamblers': 1}):
+                for team in ('a', 'b'):
+                    placed.update((d['id'], name, team) for name in d[team]['gamblers'])
+            accepted = [name for (match_id, name), (team, _) in bets.items() if (match_id, name, team) in placed]
+            for name in sorted(set(accepted)):
+                _register_gambler(name)
+            logging.info('Bets flushed: tournament={} queued={} modified={}'.format(
+                dbname, len(bets), r.modified_count))
+            return len(accepted)
+
+
+bet_queue = BetQueue(interval=BET_QUEUE_INTERVAL, batch_size=BET_QUEUE_BATCH)
 
 
 def update_match_weight(match_id: str, weight: Union[float, int]):
@@ -422,6 +787,7 @@ def update_match_weight(match_id: str, weight: Union[float, int]):
         {"id": match_id},
         {"$set": {"weight": float(weight)}}
     )
+    update_ledger(match_id)
 
 
 def update_match_time(match_id: str, match_time: datetime.datetime):
@@ -436,12 +802,48 @@ def update_match_time(match_id: str, match_time: datetime.datetime):
         {"id": match_id},
         {"$set": {"id": _generate_match_id(match_time, match.a['team'], match.b['team']), "match_time": match_time}}
     )
+    # id 与比赛顺序均已改变 重建 ledger
+    update_ledger()
+
 
+def find_matches(reverse=False, limit=0, before_id=None, after_id=None) -> List[Match]:
+    """返回所有比赛 默认为 id 升序
 
-def find_matches(reverse=False, limit=0) -> List[Match]:
-    """返回所有比赛 默认为 id 升序"""
+    before_id / after_id 只返回 id 小于 / 大于该值的比赛 用于翻页
+    """
+    query = {}
+    if before_id:
+        query.setdefault('id', {})['$lt'] = before_id
+    if after_id:
+        query.setdefault('id', {})['$gt'] = after_id
     direction = pymongo.DESCENDING if reverse else pymongo.ASCENDING
-    return [Match.from_mongo(m) for m in tournamentdb.match.find().sort('id', direction=direction).limit(limit)]
+    return [Match.from_mongo(m) for m in tournamentdb.match.find(query).sort('id', direction=direction).limit(limit)]
+
+
+def iter_matches(batch_size=MATCH_BATCH_SIZE, order='id') -> Iterator[Match]:
+    """逐条返回所有比赛 每次从数据库读取 batch_size 条
+
+    order 为 id 或 match_time (相同时间按 id)
+    """
+    sort = {'id': [('id', pymongo.ASCENDING)], 'match_time': LEDGER_ORDER}[order]
+    for m in tournamentdb.match.find().sort(sort).batch_size(batch_size):
+        yield Match.from_mongo(m)
+
+
+def _chunks(iterable, size: int) -> Iterator[list]:
+    """每 size 个元素返回一批"""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def find_unsettled_matches(after: datetime.datetime) -> List[Match]:
+    """返回 after 之后开赛且尚无比分的比赛"""
+    return [Match.from_mongo(m) for m in tournamentdb.match.find(
+        {'match_time': {'$gte': after}, '$or': [{'a.score': None}, {'b.score': None}]}).sort('match_time')]
 
 
 def find_match_by_id(match_id: str) -> Optional[Match]:
@@ -458,22 +860,423 @@ def find_match_by_id(match_id: str) -> Optional[Match]:
 
 class Series:
 
-    def __init__(self, gambler: str, matches: list, required_gamblers: List[Gambler]):
+    def __init__(self, gambler: str):
         self.gambler = gambler
         self.points = OrderedDict()
-        self._add_matches(matches, required_gamblers)
 
-    def _add_matches(self, matches: list, required_gamblers: List[Gambler]):
-        latest = 0
-        for match in sorted(matches, key=lambda m: m.match_time):
-            if not match.has_score():
-                continue
-            result = match.update_profit_and_loss_result(required_gamblers=required_gamblers)
-            latest += result and result.get(self.gambler) or 0
-            self.points[match.id] = latest
+    def add_point(self, match_id: str, delta: Union[float, int]):
+        """在序列末尾追加一场比赛 积分为上一场累计值加本场损益"""
+        latest = self.points[next(reversed(self.points))] if self.points else 0
+        self.points[match_id] = latest + delta
+
 
+def _series_from_totals(gambler: str, match_ids: List[str], totals: List[float]) -> Series:
+    series = Series(gambler)
+    series.points = OrderedDict(zip(match_ids, totals))
+    return series
 
+
+def settle_matches(matches: Iterable[Match], required_gamblers: List[Gambler]) -> Iterator[Tuple[Match, dict]]:
+    """逐场结算 每场只结算一次
+
+    matches 须按比赛时间顺序 (iter_matches(order='match_time')) 传入
+    """
+    for match in matches:
+        if not match.has_score():
+            continue
+        yield match, match.update_profit_and_loss_result(required_gamblers=required_gamblers)
+
+
+@metrics.SETTLEMENT_DURATION.time(operation='generate_series')
 def generate_series() -> List[Series]:
     gamblers = find_gamblers()
-    matches = find_matches()
-    return [Series(gambler.name, matches, gamblers) for gambler in gamblers]
+    if kernel:
+        # 每次结算一批比赛 累计积分带入下一批
+        many_series = [Series(gambler.name) for gambler in gamblers]
+        carry = None
+        for chunk in _chunks(iter_matches(order='match_time'), MATCH_BATCH_SIZE):
+            settlement = kernel.settle(chunk, gamblers, carry=carry)
+            if not settlement.match_ids:
+                continue
+            for series, totals in zip(many_series, settlement.totals.tolist()):
+                series.points.update(zip(settlement.match_ids, totals))
+            carry = settlement.totals[:len(gamblers), -1]
+        return many_series
+    many_series = [Series(gambler.name) for gambler in gamblers]
+    # 每场比赛结算一次 再把各玩家的损益分发到对应序列
+    for match, result in settle_matches(iter_matches(order='match_time'), gamblers):
+        for series in many_series:
+            series.add_point(match.id, result and result.get(series.gambler) or 0)
+    return many_series
+
+
+# class Ledger:
+#     id = '201806010100-法国-西班牙'
+#     match_time = datetime.datetime(2018, 6, 1, 1, 0)
+#     result = [{'name': 'g1', 'value': -2.0}, {'name': 'g2', 'value': 2.0}]     # 本场损益
+#     totals = [{'name': 'g1', 'value': 15.0}, {'name': 'g2', 'value': 17.0}]    # 截至本场的累计积分
+#
+# 玩家名由用户输入 可能含 '.' 或以 '$' 开头 不能用作字段名
+
+LEDGER_ORDER = [('match_time', pymongo.ASCENDING), ('id', pymongo.ASCENDING)]
+LEDGER_SCHEMA = 2   # ledger 记录格式变化时递增 旧格式的 ledger 由 ensure_ledger() 重建
+
+
+def _ledger_values(values: dict) -> List[dict]:
+    """{name: value} -> [{'name': name, 'value': value}]"""
+    return [{'name': str(name), 'value': value} for name, value in values.items()]
+
+
+def _ledger_dict(entries: List[dict]) -> dict:
+    """[{'name': name, 'value': value}] -> {name: value}"""
+    return {entry['name']: entry['value'] for entry in entries}
+
+# ledger 写锁 (meta 中 _id='ledger_lock' 的记录) 保证同一 tournament 同时只有一处更新累计积分
+# 持锁进程崩溃时锁在 LEDGER_LOCK_TTL 后自动失效
+LEDGER_LOCK_TTL = datetime.timedelta(minutes=10)
+LEDGER_LOCK_WAIT = 30       # 等待锁的最长时间 (秒)
+LEDGER_LOCK_POLL = 0.1
+
+
+class LedgerLocked(RuntimeError):
+    """ledger 正被其他进程 / 线程更新"""
+
+
+@contextlib.contextmanager
+def _ledger_lock(wait: float = LEDGER_LOCK_WAIT):
+    owner = str(bson.ObjectId())
+    for attempt in itertools.count():
+        now = datetime.datetime.utcnow()
+        try:
+            # 锁不存在或已过期时获得锁 否则 upsert 因 _id 重复失败
+            tournamentdb.meta.update_one({'_id': 'ledger_lock', 'expires': {'$lt': now}},
+                                         {'$set': {'owner': owner, 'expires': now + LEDGER_LOCK_TTL}}, upsert=True)
+            break
+        except pymongo.errors.DuplicateKeyError:
+            if attempt * LEDGER_LOCK_POLL >= wait:
+                raise LedgerLocked(tournamentdb.name)
+            time.sleep(LEDGER_LOCK_POLL)
+    try:
+        yield
+    finally:
+        tournamentdb.meta.delete_one({'_id': 'ledger_lock', 'owner': owner})
+
+
+# ledger 状态 (meta 中 _id='ledger' 的记录)
+#     不存在       从未建立 (旧数据)
+#     stale       已过期 (新玩家加入) 值为标记时生成的随机值 下次读取或轮询时重建
+#     schema      ledger 记录格式 与 LEDGER_SCHEMA 不同时重建
+
+
+def _ledger_ready(state: Optional[dict]) -> bool:
+    """ledger 已建立 未过期且格式为当前格式"""
+    return bool(state) and not state.get('stale') and state.get('schema') == LEDGER_SCHEMA
+
+def invalidate_ledger():
+    """标记 ledger 过期 由 ensure_ledger() 在读取时重建"""
+    tournamentdb.meta.update_one({'_id': 'ledger'}, {'$set': {'stale': str(bson.ObjectId())}}, upsert=True)
+    bump_version()
+
+
+def ensure_ledger() -> bool:
+    """ledger 从未建立 (已有比赛结果) 或已过期时重建 返回是否重建
+
+    其他进程正在更新 ledger 时直接返回
+    """
+    state = tournamentdb.meta.find_one({'_id': 'ledger'})
+    if _ledger_ready(state):
+        return False
+    if not state and not tournamentdb.match.find_one({'a.score': {'$ne': None}, 'b.score': {'$ne': None}}, {'_id': 1}):
+        return False
+    try:
+        update_ledger(wait=0)
+    except LedgerLocked:
+        return False
+    return True
+
+
+@metrics.SETTLEMENT_DURATION.time(operation='update_ledger')
+def update_ledger(*match_ids: str, wait: float = LEDGER_LOCK_WAIT):
+    """更新持久化的结算结果
+
+    指定 match_ids 时只重新结算这些比赛 再顺延更新其后比赛的累计积分
+    不指定 或 ledger 从未建立 / 已过期 / 格式已变化时重建整个 ledger
+    持有 ledger 写锁 wait 秒内未获得锁时抛出 LedgerLocked
+    """
+    with _ledger_lock(wait):
+        state = tournamentdb.meta.find_one({'_id': 'ledger'})
+        if match_ids and _ledger_ready(state):
+            _update_ledger_entries(match_ids)
+        else:
+            _rebuild_ledger(state)
+
+
+def _ledger_entries(gamblers: List[Gambler]) -> Iterator[List[dict]]:
+    """逐批结算全部比赛 每批返回一组 ledger 记录 结果与逐场结算一致"""
+    names = [gambler.name for gambler in gamblers]
+    if kernel:
+        carry = None
+        for chunk in _chunks(iter_matches(order='match_time'), MATCH_BATCH_SIZE):
+            settlement = kernel.settle(chunk, gamblers, carry=carry)
+            if not settlement.match_ids:
+                continue
+            row = {name: i for i, name in enumerate(settlement.gamblers)}
+            matches = {match.id: match for match in chunk}
+            entries = []
+            for match_id, result, totals in zip(settlement.match_ids, settlement.results.T.tolist(),
+                                                settlement.totals[:len(names)].T.tolist()):
+                match = matches[match_id]
+                # 与 Match.update_profit_and_loss_result() 相同 记录本场投注者及全部参与结算的玩家
+                bettors = match.a['gamblers'] + match.b['gamblers'] + names
+                entries.append(dict(id=match_id, match_time=match.match_time,
+                                    result=_ledger_values({name: result[row[name]] for name in bettors}),
+                                    totals=_ledger_values(dict(zip(names, totals)))))
+            carry = settlement.totals[:len(names), -1]
+            yield entries
+        return
+
+    totals = {}
+    for chunk in _chunks(settle_matches(iter_matches(order='match_time'), gamblers), MATCH_BATCH_SIZE):
+        entries = []
+        for match, result in chunk:
+            result = {str(k): v for k, v in result.items()}
+            totals = {name: totals.get(name, 0) + (result.get(name) or 0) for name in names}
+            entries.append(dict(id=match.id, match_time=match.match_time,
+                                result=_ledger_values(result), totals=_ledger_values(totals)))
+        yield entries
+
+
+def _rebuild_ledger(state: Optional[dict]):
+    tournamentdb.ledger.delete_many({})
+    for entries in _ledger_entries(find_gamblers()):
+        tournamentdb.ledger.insert_many(entries)
+
+    # 重建期间再次被标记过期时保留标记
+    built_at = datetime.datetime.utcnow().replace(microsecond=0)
+    if state is None:
+        tournamentdb.meta.update_one({'_id': 'ledger'},
+                                     {'$setOnInsert': {'built_at': built_at, 'schema': LEDGER_SCHEMA}}, upsert=True)
+    else:
+        tournamentdb.meta.update_one({'_id': 'ledger', 'stale': state.get('stale')},
+                                     {'$set': {'built_at': built_at, 'schema': LEDGER_SCHEMA},
+                                      '$unset': {'stale': ''}})
+    bump_version()
+
+
+def _update_ledger_entries(match_ids: Tuple[str, ...]):
+    gamblers = find_gamblers()
+
+    # 只新增排在最后一场之后的比赛时 客户端可增量获取 (见 appended_since())
+    tail = tournamentdb.ledger.find_one({}, {'id': 1, 'match_time': 1}, sort=[('match_time', pymongo.DESCENDING),
+                                                                             ('id', pymongo.DESCENDING)])
+    append = True
+
+    # 重新结算受影响的比赛
+    earliest = None
+    for match_id in match_ids:
+        match = find_match_by_id(match_id)
+        previous = tournamentdb.ledger.find_one({'id': match_id}, {'match_time': 1})
+        if match and match.has_score():
+            result = match.update_profit_and_loss_result(required_gamblers=gamblers)
+            tournamentdb.ledger.update_one(
+                {'id': match_id},
+                {'$set': {'match_time': match.match_time, 'result': _ledger_values(result)}},
+                upsert=True,
+            )
+        elif previous:
+            tournamentdb.ledger.delete_one({'id': match_id})
+        else:
+            # 未结算且不在 ledger 中 无需更新
+            continue
+        if previous or (tail and (match.match_time, match.id) <= (tail['match_time'], tail['id'])):
+            append = False
+        for t in (match and match.match_time, previous and previous['match_time']):
+            if t and (earliest is None or t < earliest):
+                earliest = t
+
+    if earliest is None:
+        return
+
+    # 从最早受影响的比赛开始顺延累计积分
+    last = tournamentdb.ledger.find_one({'match_time': {'$lt': earliest}}, sort=[('match_time', pymongo.DESCENDING),
+                                                                                 ('id', pymongo.DESCENDING)])
+    totals = _ledger_dict(last['totals']) if last else {}
+    ops = []
+    for entry in tournamentdb.ledger.find({'match_time': {'$gte': earliest}}).sort(LEDGER_ORDER):
+        result = _ledger_dict(entry['result'])
+        totals = {gambler.name: totals.get(gambler.name, 0) + (result.get(gambler.name) or 0) for gambler in gamblers}
+        ops.append(pymongo.UpdateOne({'_id': entry['_id']}, {'$set': {'totals': _ledger_values(totals)}}))
+    if ops:
+        tournamentdb.ledger.bulk_write(ops)
+    bump_version(append=append)
+
+
+@metrics.SETTLEMENT_DURATION.time(operation='find_series')
+def find_series() -> List[Series]:
+    """从 ledger 读取各玩家积分序列 结果与 generate_series() 一致"""
+    ensure_ledger()
+    many_series = [Series(gambler.name) for gambler in find_gamblers()]
+    for entry in tournamentdb.ledger.find({}, {'id': 1, 'totals': 1}).sort(LEDGER_ORDER):
+        totals = _ledger_dict(entry['totals'])
+        for series in many_series:
+            series.points[entry['id']] = totals.get(series.gambler, 0)
+    return many_series
+
+
+# 数据版本
+# board 展示的数据 (ledger / gambler) 每次变化都更新版本号 用作 /board 的 ETag 及缓存 key
+# 版本号用 ObjectId 生成 即使数据库被清空重建也不会与旧版本重复
+# base 为最近一次非追加变化的版本 appends 为其后只在 ledger 末尾追加比赛的版本
+
+VERSION_HISTORY = 100   # 最多保留的追加版本数
+
+
+def bump_version(db=None, append=False):
+    """更新 tournament 数据版本
+
+    append 表示本次变化只是在 ledger 末尾追加了比赛
+    """
+    db = tournamentdb if db is None else db
+    version = str(bson.ObjectId())
+    update = {'$set': {'version': version, 'updated_at': datetime.datetime.utcnow().replace(microsecond=0)}}
+    if append:
+        update['$push'] = {'appends': {'$each': [version], '$slice': -VERSION_HISTORY}}
+    else:
+        update['$set'].update(base=version, appends=[])
+    db.meta.update_one({'_id': 'version'}, update, upsert=True)
+
+
+def appended_since(version: str) -> bool:
+    """version 之后的变化是否都只是在 ledger 末尾追加比赛"""
+    d = tournamentdb.meta.find_one({'_id': 'version'}, {'base': 1, 'appends': 1})
+    if not d or not version:
+        return False
+    return version == d.get('base') or version in d.get('appends', [])
+
+
+def find_version() -> Tuple[str, Optional[datetime.datetime]]:
+    """返回当前 tournament 数据版本及更新时间 (utc)"""
+    d = tournamentdb.meta.find_one({'_id': 'version'})
+    if not d:
+        return '', None
+    return d['version'], d['updated_at']
+
+
+# 降采样
+# 比赛场次很多时 board 只需展示有限的点 每轮 (weight_schedule 的分界) 最后一场的积分始终精确保留
+
+def round_boundaries(match_ids: List[str], weight_schedule: list) -> List[str]:
+    """每轮最后一场比赛的 id 及最后一场比赛的 id"""
+    boundaries = []
+    for t, _ in weight_schedule:
+        # id 以 %Y%m%d%H%M 格式的比赛时间开头 见 _generate_match_id()
+        before = [match_id for match_id in match_ids if match_id[:12] < t.strftime('%Y%m%d%H%M')]
+        if before and before[-1] not in boundaries:
+            boundaries.append(before[-1])
+    if match_ids and match_ids[-1] not in boundaries:
+        boundaries.append(match_ids[-1])
+    return boundaries
+
+
+def _lttb_indices(many_values: List[List[float]], threshold: int) -> List[int]:
+    """Largest-Triangle-Three-Buckets 多条序列共用 x 轴 三角形面积取各序列之和"""
+    n = len(many_values[0])
+    if threshold >= n:
+        return list(range(n))
+    if threshold < 3:
+        return [0, n - 1]
+
+    every = (n - 2) / (threshold - 2)
+    selected, a = [0], 0
+    for i in range(threshold - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        next_start, next_end = end, min(int((i + 2) * every) + 1, n)
+        avg_x = (next_start + next_end - 1) / 2
+        avg_ys = [sum(values[next_start:next_end]) / (next_end - next_start) for values in many_values]
+
+        def area(j):
+            return sum(abs((a - avg_x) * (values[j] - values[a]) - (a - j) * (avg_y - values[a]))
+                       for values, avg_y in zip(many_values, avg_ys))
+
+        a = max(range(start, end), key=area)
+        selected.append(a)
+    selected.append(n - 1)
+    return selected
+
+
+def downsample_series(many_series: List[Series], max_points: int, mode='lttb', weight_schedule=()) -> List[Series]:
+    """降采样积分序列
+
+    mode='round' 只保留每轮最后一场
+    mode='lttb' 以 LTTB 选取至多 max_points 个点 另外保留每轮最后一场
+    """
+    if not many_series:
+        return many_series
+    match_ids = list(many_series[0].points.keys())
+    boundaries = round_boundaries(match_ids, weight_schedule)
+
+    if mode == 'round':
+        selected = set(boundaries)
+    elif mode == 'lttb':
+        if len(match_ids) <= max_points:
+            return many_series
+        many_values = [list(series.points.values()) for series in many_series]
+        indices = _lttb_indices(many_values, max(max_points - len(boundaries), 2))
+        selected = set(boundaries) | {match_ids[i] for i in indices}
+    else:
+        raise ValueError(f'Expect mode to be: round or lttb, but got: {mode}')
+
+    return [_series_from_totals(series.gambler, [k for k in match_ids if k in selected],
+                                [v for k, v in series.points.items() if k in selected])
+            for series in many_series]
+
+
+# 索引
+# 热点查询: match.id / match 按 id 或比赛时间排序 / auction.team / gambler.name / user.openid / user.name
+# update_user_name 按 a.gamblers / b.gamblers 查找 insert_auction 按 a.team / b.team 查找
+
+LOGIN_INDEXES = {
+    'user': [pymongo.IndexModel('openid', unique=True), pymongo.IndexModel('name')],
+}
+
+TOURNAMENT_INDEXES = {
+    'match': [
+        pymongo.IndexModel('id', unique=True),
+        pymongo.IndexModel([('match_time', pymongo.ASCENDING), ('id', pymongo.ASCENDING)]),
+        pymongo.IndexModel('a.gamblers'),
+        pymongo.IndexModel('b.gamblers'),
+        pymongo.IndexModel('a.team'),
+        pymongo.IndexModel('b.team'),
+    ],
+    'auction': [pymongo.IndexModel('team', unique=True), pymongo.IndexModel('gambler')],
+    'gambler': [pymongo.IndexModel('name', unique=True)],
+    'ledger': [pymongo.IndexModel('id', unique=True), pymongo.IndexModel(LEDGER_ORDER)],
+}
+
+
+def _all_indexes():
+    yield logindb, LOGIN_INDEXES
+    for tournament in TOURNAMENTS:
+        yield dbclient[tournament.dbname], TOURNAMENT_INDEXES
+
+
+def ensure_indexes() -> List[str]:
+    """创建全部索引 返回创建的索引名称 (已存在的索引不受影响)"""
+    created = []
+    for db, indexes in _all_indexes():
+        for collection, models in indexes.items():
+            names = db[collection].create_indexes(models)
+            created.extend(f'{db.name}.{collection}.{name}' for name in names)
+    return created
+
+
+def missing_indexes() -> List[str]:
+    """返回尚未创建的索引"""
+    missing = []
+    for db, indexes in _all_indexes():
+        for collection, models in indexes.items():
+            existing = {tuple(map(tuple, info['key'])) for info in db[collection].index_information().values()}
+            for model in models:
+                if tuple(model.document['key'].items()) not in existing:
+                    missing.append(f'{db.name}.{collection}.{model.document["name"]}')
+    return missing
@@ -0,0 +1,70 @@
+# coding: utf-8
+"""数据库命令统计
+
+统计每个请求 / 每条 CLI 命令 (即每个 app context) 执行的数据库命令数及耗时
+MongoDB 通过 pymongo 的 CommandListener 统计 进程内存储 (storage.py) 在每次操作后直接调用 record()
+"""
+
+from flask import g, has_app_context
+from pymongo import monitoring
+
+
+class DbStats:
+    """一个 app context 内的数据库命令统计"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = None     # (command, seconds)
+
+    def add(self, command: str, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        if self.slowest is None or seconds > self.slowest[1]:
+            self.slowest = (command, seconds)
+
+    def summary(self) -> str:
+        slowest = '{}({:.1f}ms)'.format(self.slowest[0], self.slowest[1] * 1000) if self.slowest else '-'
+        return 'commands={} time={:.1f}ms slowest={}'.format(self.count, self.seconds * 1000, slowest)
+
+    def server_timing(self) -> str:
+        """Server-Timing 响应头"""
+        return 'db;desc="{} commands";dur={:.1f}'.format(self.count, self.seconds * 1000)
+
+
+def start() -> DbStats:
+    """重新开始统计 (每个请求开始时调用)"""
+    g._db_stats = DbStats()
+    return g._db_stats
+
+
+def current() -> DbStats:
+    """当前 app context 的统计 不在 app context 内时返回 None"""
+    if not has_app_context():
+        return None
+    if '_db_stats' not in g:
+        g._db_stats = DbStats()
+    return g._db_stats
+
+
+def record(command: str, seconds: float):
+    """记录一条数据库命令"""
+    stats = current()
+    if stats is not None:
+        stats.add(command, seconds)
+
+
+class CommandCounter(monitoring.CommandListener):
+    """pymongo 命令监听 在发出命令的线程中回调"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record(event.command_name, event.duration_micros / 1e6)
+
+
+listener = CommandCounter()
@@ -0,0 +1,835 @@
+# coding: utf-8
+"""存储后端
+
+MONGO_URI 的 scheme 决定使用的存储
+    mongodb://...       MongoDB (pymongo)
+    memory://           进程内存储 数据只在本进程内
+    sqlite:///path      进程内存储 同时写入 SQLite 文件 启动时加载
+
+进程内存储实现了本项目用到的 pymongo 接口 (MongoClient / Database / Collection / Cursor 的常用方法)
+查询全部在内存中完成 没有网络往返 适合小规模部署 测试及基准
+与 MongoDB 的差异
+    - 索引不参与查询 只用于检查 unique
+    - 没有 explain()
+    - 进程之间不共享数据 (sqlite 模式下只应有一个进程写入)
+"""
+
+import bson
+import bson.json_util
+import datetime
+import functools
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import List, Optional
+
+import pymongo
+import pymongo.errors
+
+from . import monitor
+
+
+def connect(uri: str):
+    """根据 uri 返回 MongoClient 或进程内存储"""
+    if uri.startswith('memory://'):
+        return MemoryClient()
+    if uri.startswith('sqlite://'):
+        return MemoryClient(path=uri[len('sqlite://'):])
+    return pymongo.MongoClient(uri, event_listeners=[monitor.listener])
+
+
+InsertOneResult = namedtuple('InsertOneResult', ['inserted_id'])
+InsertManyResult = namedtuple('InsertManyResult', ['inserted_ids'])
+UpdateResult = namedtuple('UpdateResult', ['matched_count', 'modified_count', 'upserted_id'])
+DeleteResult = namedtuple('DeleteResult', ['deleted_count'])
+BulkWriteResult = namedtuple('BulkWriteResult', ['inserted_count', 'matched_count', 'modified_count',
+                                                 'deleted_count', 'upserted_count', 'upserted_ids'])
+
+
+# 查询
+
+_missing = object()
+
+
+def _copy(value):
+    """复制文档 datetime / ObjectId 等不可变值直接共用"""
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _get(doc, path: str):
+    """按 a.b.c 路径取值 数组中的子文档取值后展开为列表"""
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, _missing)
+        elif isinstance(value, list):
+            if part.isdigit():
+                value = value[int(part)] if int(part) < len(value) else _missing
+            else:
+                values = [_get(v, part) for v in value if isinstance(v, dict)]
+                value = [v for v in values if v is not _missing] or _missing
+        else:
+            return _missing
+        if value is _missing:
+            return _missing
+    return value
+
+
+def _number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+_COMPARABLE_TYPES = (str, datetime.datetime, bson.ObjectId, bool, bytes)
+
+
+def _comparable(a, b) -> bool:
+    """MongoDB 只比较同类型的值"""
+    if _number(a) and _number(b):
+        return True
+    return any(isinstance(a, t) and isinstance(b, t) for t in _COMPARABLE_TYPES)
+
+
+def _compare(op: str, value, target) -> bool:
+    if not _comparable(value, target):
+        return False
+    if op == '$gt':
+        return value > target
+    if op == '$gte':
+        return value >= target
+    if op == '$lt':
+        return value < target
+    return value <= target
+
+
+def _candidates(value) -> list:
+    """数组字段的条件对数组本身及其中每个元素生效"""
+    if isinstance(value, list):
+        return [value] + value
+    return [value]
+
+
+def _equals(value, target) -> bool:
+    if target is None:
+        return value is _missing or value is None or (isinstance(value, list) and None in value)
+    if value is _missing:
+        return False
+    return any(v == target and (_number(v) == _number(target)) for v in _candidates(value))
+
+
+def _match_condition(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        for op, target in condition.items():
+            if op == '$eq':
+                ok = _equals(value, target)
+            elif op == '$ne':
+                ok = not _equals(value, target)
+            elif op in ('$gt', '$gte', '$lt', '$lte'):
+                ok = value is not _missing and any(_compare(op, v, target) for v in _candidates(value))
+            elif op == '$in':
+                ok = any(_equals(value, t) for t in target)
+            elif op == '$nin':
+                ok = not any(_equals(value, t) for t in target)
+            elif op == '$exists':
+                ok = (value is not _missing) == bool(target)
+            elif op == '$not':
+                ok = not _match_condition(value, target)
+            else:
+                raise pymongo.errors.OperationFailure(f'unknown operator: {op}')
+            if not ok:
+                return False
+        return True
+    return _equals(value, condition)
+
+
+def match(doc: dict, query: dict) -> bool:
+    """文档是否满足查询条件"""
+    for key, condition in (query or {}).items():
+        if key == '$or':
+            ok = any(match(doc, q) for q in condition)
+        elif key == '$and':
+            ok = all(match(doc, q) for q in condition)
+        elif key == '$nor':
+            ok = not any(match(doc, q) for q in condition)
+        else:
+            ok = _match_condition(_get(doc, key), condition)
+        if not ok:
+            return False
+    return True
+
+
+def _project(doc: dict, projection) -> dict:
+    if not projection:
+        return _copy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include_id = projection.get('_id', 1)
+    fields = {k: v for k, v in projection.items() if k != '_id'}
+    if fields and any(fields.values()):
+        result = {}
+        if include_id and '_id' in doc:
+            result['_id'] = doc['_id']
+        for path in fields:
+            value = _get(doc, path)
+            if value is _missing:
+                continue
+            target, parts = result, path.split('.')
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = _copy(value)
+        return result
+    result = _copy(doc)
+    if not include_id:
+        result.pop('_id', None)
+    for path in fields:
+        target, parts = result, path.split('.')
+        for part in parts[:-1]:
+            target = target.get(part) if isinstance(target, dict) else None
+        if isinstance(target, dict):
+            target.pop(parts[-1], None)
+    return result
+
+
+# 排序时不同类型的先后顺序 与 MongoDB 相同
+_TYPE_ORDER = [(type(None), 1), (bool, 8), (int, 2), (float, 2), (str, 3), (dict, 4), (list, 5),
+               (bytes, 6), (bson.ObjectId, 7), (datetime.datetime, 9)]
+
+
+def _sort_value(value):
+    if value is _missing:
+        value = None
+    for t, rank in _TYPE_ORDER:
+        if isinstance(value, t):
+            if isinstance(value, (dict, list)):
+                return rank, repr(value)
+            return rank, (value if value is not None else 0)
+    return 10, repr(value)
+
+
+def _sort(docs: list, keys: list) -> list:
+    # 从最后一个 key 开始逐个稳定排序
+    for key, direction in reversed(keys):
+        docs.sort(key=lambda d: _sort_value(_get(d, key)), reverse=direction == pymongo.DESCENDING)
+    return docs
+
+
+# 更新
+
+def _set(doc: dict, path: str, value):
+    parts = path.split('.')
+    target = doc
+    for part in parts[:-1]:
+        if isinstance(target, list):
+            target = target[int(part)]
+        else:
+            target = target.setdefault(part, {})
+    if isinstance(target, list):
+        target[int(parts[-1])] = value
+    else:
+        target[parts[-1]] = value
+
+
+def _unset(doc: dict, path: str):
+    parts = path.split('.')
+    target = doc
+    for part in parts[:-1]:
+        target = target.get(part) if isinstance(target, dict) else None
+    if isinstance(target, dict):
+        return target.pop(parts[-1], _missing)
+    return _missing
+
+
+def _positional(doc: dict, query: dict, path: str) -> str:
+    """把 a.gamblers.$ 中的 $ 替换为查询条件匹配到的数组下标"""
+    parts = path.split('.')
+    if '$' not in parts:
+        return path
+    i = parts.index('$')
+    array_path, rest = '.'.join(parts[:i]), ''.join('.' + part for part in parts[i + 1:])
+    array = _get(doc, array_path)
+    if isinstance(array, list):
+        for key, condition in (query or {}).items():
+            if key == array_path or key.startswith(array_path + '.'):
+                sub = key[len(array_path) + 1:]
+                for i, item in enumerate(array):
+                    value = _get(item, sub) if sub else item
+                    if _match_condition(value, condition):
+                        return f'{array_path}.{i}{rest}'
+    raise pymongo.errors.WriteError('The positional operator did not find the match needed from the query.')
+
+
+def _filtered(doc: dict, path: str, array_filters: Optional[list]) -> List[str]:
+    """把 result.$[e].name 中的 $[e] 展开为 array_filters 匹配到的全部数组下标"""
+    head, sep, rest = path.partition('.$[')
+    if not sep:
+        return [path]
+    ident, _, rest = rest.partition(']')
+    conditions = {}
+    for f in array_filters or []:
+        for key, condition in f.items():
+            if key == ident or key.startswith(ident + '.'):
+                conditions[key[len(ident) + 1:]] = condition
+    if not conditions:
+        raise pymongo.errors.WriteError(f'No array filter found for identifier {ident!r} in path {path!r}')
+    array = _get(doc, head)
+    if not isinstance(array, list):
+        return []
+    paths = []
+    for i, item in enumerate(array):
+        if all(_match_condition(_get(item, sub) if sub else item, condition) for sub, condition in conditions.items()):
+            paths += _filtered(doc, f'{head}.{i}{rest}', array_filters)
+    return paths
+
+
+def _apply_update(doc: dict, update: dict, query: dict, inserting: bool, array_filters: Optional[list] = None):
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, value in fields.items():
+            for path in _filtered(doc, _positional(doc, query, path), array_filters):
+                _apply_operator(doc, op, path, value)
+
+
+def _apply_operator(doc: dict, op: str, path: str, value):
+    if op in ('$set', '$setOnInsert'):
+        _set(doc, path, _copy(value))
+    elif op == '$unset':
+        _unset(doc, path)
+    elif op == '$inc':
+        current = _get(doc, path)
+        _set(doc, path, (0 if current is _missing else current) + value)
+    elif op == '$rename':
+        moved = _unset(doc, path)
+        if moved is not _missing:
+            _set(doc, value, moved)
+    elif op in ('$push', '$addToSet', '$pull'):
+        array = _get(doc, path)
+        if array is _missing:
+            array = []
+            if op != '$pull':
+                _set(doc, path, array)
+        if not isinstance(array, list):
+            raise pymongo.errors.WriteError(f'{op} requires an array: {path}')
+        if op == '$pull':
+            array[:] = [item for item in array if not _match_condition(item, value)]
+            return
+        values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+        for v in values:
+            if op == '$push' or v not in array:
+                array.append(_copy(v))
+        if op == '$push' and isinstance(value, dict) and '$slice' in value:
+            n = value['$slice']
+            array[:] = array[n:] if n < 0 else array[:n]
+    else:
+        raise pymongo.errors.WriteError(f'unknown update operator: {op}')
+
+
+def _upsert_document(query: dict) -> dict:
+    """upsert 时由查询中的等值条件生成新文档"""
+    doc = {}
+    for key, condition in query.items():
+        if key.startswith('$') or (isinstance(condition, dict) and any(k.startswith('$') for k in condition)):
+            continue
+        _set(doc, key, _copy(condition))
+    return doc
+
+
+def _check_update(update: dict):
+    if not update or not all(k.startswith('$') for k in update):
+        raise ValueError('update only works with $ operators')
+
+
+def _check_replacement(replacement: dict):
+    if any(k.startswith('$') for k in replacement):
+        raise ValueError('replacement can not include $ operators')
+
+
+def _command(name: str):
+    """以 MongoDB 命令名记录每次操作的耗时 (见 monitor.py)"""
+    def decorator(f):
+        @functools.wraps(f)
+        def _(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                monitor.record(name, time.perf_counter() - start)
+        return _
+    return decorator
+
+
+# 客户端
+
+class MemoryClient:
+    """进程内存储 接口与 pymongo.MongoClient 相同"""
+
+    def __init__(self, path: str = None):
+        self._databases = {}
+        self._lock = threading.RLock()
+        self._sqlite = None
+        if path:
+            self._sqlite = sqlite3.connect(path, check_same_thread=False)
+            self._sqlite.execute('CREATE TABLE IF NOT EXISTS document ('
+                                 'db TEXT, collection TEXT, id TEXT, doc TEXT, PRIMARY KEY (db, collection, id))')
+            self._sqlite.execute('CREATE TABLE IF NOT EXISTS index_info ('
+                                 'db TEXT, collection TEXT, name TEXT, spec TEXT, PRIMARY KEY (db, collection, name))')
+            self._sqlite.commit()
+            self._load()
+
+    def __getitem__(self, name: str) -> 'MemoryDatabase':
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(self, name)
+            return self._databases[name]
+
+    def __getattr__(self, name: str) -> 'MemoryDatabase':
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def list_database_names(self) -> list:
+        return [name for name, db in self._databases.items() if db.list_collection_names()]
+
+    def drop_database(self, name):
+        name = getattr(name, 'name', name)
+        with self._lock:
+            db = self._databases.pop(name, None)
+            if db is not None:
+                for collection in list(db._collections):
+                    db.drop_collection(collection)
+
+    def close(self):
+        if self._sqlite:
+            self._sqlite.close()
+
+    # SQLite 持久化 每次写操作后同步写入
+
+    _json_options = bson.json_util.JSONOptions(json_mode=bson.json_util.JSONMode.CANONICAL, tz_aware=False)
+
+    def _load(self):
+        for db, collection, doc in self._sqlite.execute('SELECT db, collection, doc FROM document ORDER BY rowid'):
+            doc = bson.json_util.loads(doc, json_options=self._json_options)
+            self[db][collection]._docs[self._key(doc['_id'])] = doc
+        for db, collection, name, spec in self._sqlite.execute('SELECT db, collection, name, spec FROM index_info'):
+            spec = bson.json_util.loads(spec, json_options=self._json_options)
+            spec['key'] = [tuple(k) for k in spec['key']]
+            self[db][collection]._indexes[name] = spec
+            self[db][collection]._build_unique(name)
+
+    @staticmethod
+    def _key(_id):
+        return _id if not isinstance(_id, (dict, list)) else repr(_id)
+
+    def _persist(self, collection: 'MemoryCollection', saved=(), deleted=(), drop=False):
+        if not self._sqlite:
+            return
+        db = collection.database.name
+        dumps = lambda value: bson.json_util.dumps(value, json_options=self._json_options)   # noqa
+        if drop:
+            self._sqlite.execute('DELETE FROM document WHERE db = ? AND collection = ?', (db, collection.name))
+        self._sqlite.execute('DELETE FROM index_info WHERE db = ? AND collection = ?', (db, collection.name))
+        self._sqlite.executemany('DELETE FROM document WHERE db = ? AND collection = ? AND id = ?',
+                                 [(db, collection.name, dumps(_id)) for _id in deleted])
+        self._sqlite.executemany('INSERT OR REPLACE INTO document (db, collection, id, doc) VALUES (?, ?, ?, ?)',
+                                 [(db, collection.name, dumps(doc['_id']), dumps(doc)) for doc in saved])
+        self._sqlite.executemany('INSERT INTO index_info (db, collection, name, spec) VALUES (?, ?, ?, ?)',
+                                 [(db, collection.name, name, dumps(spec))
+                                  for name, spec in collection._indexes.items()])
+        self._sqlite.commit()
+
+
+class MemoryDatabase:
+
+    def __init__(self, client: MemoryClient, name: str):
+        self.client = client
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name: str) -> 'MemoryCollection':
+        with self.client._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name: str) -> 'MemoryCollection':
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def list_collection_names(self) -> list:
+        return [name for name, c in self._collections.items() if c._docs or c._indexes]
+
+    def drop_collection(self, name):
+        self[getattr(name, 'name', name)].drop()
+
+    def __repr__(self):
+        return f'MemoryDatabase({self.name!r})'
+
+
+class MemoryCollection:
+
+    def __init__(self, database: MemoryDatabase, name: str):
+        self.database = database
+        self.name = name
+        self.full_name = f'{database.name}.{name}'
+        self._docs = OrderedDict()      # {_id: document} 按插入顺序
+        self._indexes = OrderedDict()   # {name: {'key': [(field, direction)], ...}}
+        self._unique = {}               # unique 索引中已有的值 {name: {(value, ...): _id}}
+
+    @property
+    def _lock(self):
+        return self.database.client._lock
+
+    def _persist(self, **kwargs):
+        self.database.client._persist(self, **kwargs)
+
+    def _find(self, query) -> list:
+        """返回满足条件的文档 (未复制)"""
+        query = query or {}
+        if '_id' in query and not isinstance(query['_id'], dict):
+            doc = self._docs.get(MemoryClient._key(query['_id']))
+            return [doc] if doc is not None and match(doc, query) else []
+        return [doc for doc in self._docs.values() if match(doc, query)]
+
+    # 读
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0, **kwargs) -> 'MemoryCursor':
+        cursor = MemoryCursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        return next(iter(self.find(filter, projection, sort=sort, limit=1)), None)
+
+    @_command('count')
+    def count_documents(self, filter, **kwargs) -> int:
+        with self._lock:
+            return len(self._find(filter))
+
+    def estimated_document_count(self, **kwargs) -> int:
+        return len(self._docs)
+
+    def count(self, filter=None, **kwargs) -> int:
+        return self.count_documents(filter)
+
+    @_command('distinct')
+    def distinct(self, key: str, filter=None) -> list:
+        values = []
+        with self._lock:
+            for doc in self._find(filter):
+                value = _get(doc, key)
+                for v in (value if isinstance(value, list) else [value]):
+                    if v is not _missing and v not in values:
+                        values.append(v)
+        return values
+
+    # unique 索引
+
+    @staticmethod
+    def _index_key(spec: dict, doc: dict) -> tuple:
+        """文档在索引上的取值 缺少的字段视为 null"""
+        values = []
+        for field, _ in spec['key']:
+            value = _get(doc, field)
+            value = None if value is _missing else value
+            values.append(repr(value) if isinstance(value, (dict, list)) else value)
+        return tuple(values)
+
+    def _reindex(self, old: dict = None, new: dict = None):
+        """文档由 old 变为 new (插入时 old 为 None 删除时 new 为 None)
+
+        new 与其他文档在 unique 索引上重复时抛出 DuplicateKeyError 且不做任何修改
+        """
+        changes = []
+        for name, entries in self._unique.items():
+            spec = self._indexes[name]
+            old_key = self._index_key(spec, old) if old is not None else _missing
+            new_key = self._index_key(spec, new) if new is not None else _missing
+            if old_key == new_key:
+                continue
+            if new_key is not _missing and new_key in entries:
+                raise pymongo.errors.DuplicateKeyError(
+                    f'E11000 duplicate key error collection: {self.full_name} index: {name} dup key: {new_key}')
+            changes.append((entries, old_key, new_key))
+        for entries, old_key, new_key in changes:
+            entries.pop(old_key, None)
+            if new_key is not _missing:
+                entries[new_key] = new['_id']
+
+    def _build_unique(self, name: str):
+        spec = self._indexes[name]
+        if not spec.get('unique'):
+            return
+        entries = {}
+        for doc in self._docs.values():
+            key = self._index_key(spec, doc)
+            if key in entries:
+                raise pymongo.errors.DuplicateKeyError(
+                    f'E11000 duplicate key error collection: {self.full_name} index: {name} dup key: {key}')
+            entries[key] = doc['_id']
+        self._unique[name] = entries
+
+    # 写
+
+    def _insert(self, doc: dict) -> object:
+        if '_id' not in doc:
+            doc['_id'] = bson.ObjectId()
+        key = MemoryClient._key(doc['_id'])
+        if key in self._docs:
+            raise pymongo.errors.DuplicateKeyError(f'E11000 duplicate key error collection: {self.full_name}')
+        self._reindex(new=doc)
+        self._docs[key] = _copy(doc)
+        return doc['_id']
+
+    @_command('insert')
+    def insert_one(self, document: dict, **kwargs) -> InsertOneResult:
+        with self._lock:
+            inserted_id = self._insert(document)
+            self._persist(saved=[self._docs[MemoryClient._key(inserted_id)]])
+        return InsertOneResult(inserted_id)
+
+    @_command('insert')
+    def insert_many(self, documents, ordered=True, **kwargs) -> InsertManyResult:
+        inserted_ids = []
+        with self._lock:
+            try:
+                for document in documents:
+                    inserted_ids.append(self._insert(document))
+            finally:
+                self._persist(saved=[self._docs[MemoryClient._key(_id)] for _id in inserted_ids])
+        return InsertManyResult(inserted_ids)
+
+    def _update(self, filter: dict, update: dict, upsert: bool, multi: bool, replace: bool, saved: list,
+                array_filters: Optional[list] = None):
+        """返回 (matched, modified, upserted_id)"""
+        (_check_replacement if replace else _check_update)(update)
+        docs = self._find(filter)
+        if not multi:
+            docs = docs[:1]
+        modified = 0
+        for doc in docs:
+            before = _copy(doc)
+            if replace:
+                new = dict(_copy(update), _id=doc['_id'])
+                doc.clear()
+                doc.update(new)
+            else:
+                _apply_update(doc, update, filter, inserting=False, array_filters=array_filters)
+            if doc != before:
+                if doc.get('_id') != before['_id']:
+                    doc.clear()
+                    doc.update(before)
+                    raise pymongo.errors.WriteError("Performing an update on the path '_id' would modify the immutable field '_id'")
+                try:
+                    self._reindex(before, doc)
+                except pymongo.errors.DuplicateKeyError:
+                    doc.clear()
+                    doc.update(before)
+                    raise
+                modified += 1
+                saved.append(doc)
+        if docs or not upsert:
+            return len(docs), modified, None
+        if replace:
+            doc = _copy(update)
+            if '_id' not in doc and '_id' in filter and not isinstance(filter['_id'], dict):
+                doc['_id'] = filter['_id']
+        else:
+            doc = _upsert_document(filter)
+            _apply_update(doc, update, filter, inserting=True, array_filters=array_filters)
+        upserted_id = self._insert(doc)
+        saved.append(self._docs[MemoryClient._key(upserted_id)])
+        return 0, 0, upserted_id
+
+    def _write(self, filter, update, upsert, multi, replace, array_filters=None) -> UpdateResult:
+        saved = []
+        with self._lock:
+            try:
+                return UpdateResult(*self._update(filter, update, upsert, multi, replace, saved, array_filters))
+            finally:
+                self._persist(saved=saved)
+
+    @_command('update')
+    def update_one(self, filter: dict, update: dict, upsert=False, array_filters=None, **kwargs) -> UpdateResult:
+        return self._write(filter, update, upsert, multi=False, replace=False, array_filters=array_filters)
+
+    @_command('update')
+    def update_many(self, filter: dict, update: dict, upsert=False, array_filters=None, **kwargs) -> UpdateResult:
+        return self._write(filter, update, upsert, multi=True, replace=False, array_filters=array_filters)
+
+    @_command('update')
+    def replace_one(self, filter: dict, replacement: dict, upsert=False, **kwargs) -> UpdateResult:
+        return self._write(filter, replacement, upsert, multi=False, replace=True)
+
+    def _delete(self, filter: dict, multi: bool, deleted: list) -> int:
+        docs = self._find(filter)
+        if not multi:
+            docs = docs[:1]
+        for doc in docs:
+            self._reindex(old=doc)
+            del self._docs[MemoryClient._key(doc['_id'])]
+            deleted.append(doc['_id'])
+        return len(docs)
+
+    @_command('delete')
+    def delete_one(self, filter: dict, **kwargs) -> DeleteResult:
+        deleted = []
+        with self._lock:
+            self._delete(filter, False, deleted)
+            self._persist(deleted=deleted)
+        return DeleteResult(len(deleted))
+
+    @_command('delete')
+    def delete_many(self, filter: dict, **kwargs) -> DeleteResult:
+        deleted = []
+        with self._lock:
+            self._delete(filter, True, deleted)
+            self._persist(deleted=deleted)
+        return DeleteResult(len(deleted))
+
+    @_command('bulk_write')
+    def bulk_write(self, requests, ordered=True, **kwargs) -> BulkWriteResult:
+        counts = dict(inserted_count=0, matched_count=0, modified_count=0, deleted_count=0)
+        upserted_ids, saved, deleted = {}, [], []
+        with self._lock:
+            try:
+                for i, request in enumerate(requests):
+                    if isinstance(request, pymongo.InsertOne):
+                        self._insert(request._doc)
+                        saved.append(self._docs[MemoryClient._key(request._doc['_id'])])
+                        counts['inserted_count'] += 1
+                    elif isinstance(request, (pymongo.DeleteOne, pymongo.DeleteMany)):
+                        counts['deleted_count'] += self._delete(
+                            request._filter, isinstance(request, pymongo.DeleteMany), deleted)
+                    elif isinstance(request, (pymongo.UpdateOne, pymongo.UpdateMany, pymongo.ReplaceOne)):
+                        matched, modified, upserted_id = self._update(
+                            request._filter, request._doc, request._upsert,
+                            multi=isinstance(request, pymongo.UpdateMany),
+                            replace=isinstance(request, pymongo.ReplaceOne), saved=saved,
+                            array_filters=getattr(request, '_array_filters', None))
+                        counts['matched_count'] += matched
+                        counts['modified_count'] += modified
+                        if upserted_id is not None:
+                            upserted_ids[i] = upserted_id
+                    else:
+                        raise TypeError(f'{request!r} is not a valid request')
+            finally:
+                self._persist(saved=saved, deleted=deleted)
+        return BulkWriteResult(upserted_count=len(upserted_ids), upserted_ids=upserted_ids, **counts)
+
+    @_command('drop')
+    def drop(self):
+        with self._lock:
+            self._docs.clear()
+            self._indexes.clear()
+            self._unique.clear()
+            self._persist(drop=True)
+
+    # 索引
+
+    @_command('createIndexes')
+    def create_indexes(self, indexes) -> list:
+        names = []
+        with self._lock:
+            for index in indexes:
+                spec = dict(index.document)
+                spec['key'] = list(spec['key'].items())
+                name = spec.pop('name')
+                if name not in self._indexes:
+                    self._indexes[name] = spec
+                    try:
+                        self._build_unique(name)
+                    except pymongo.errors.DuplicateKeyError:
+                        del self._indexes[name]
+                        raise
+                names.append(name)
+            self._persist()
+        return names
+
+    def create_index(self, keys, **kwargs) -> str:
+        return self.create_indexes([pymongo.IndexModel(keys, **kwargs)])[0]
+
+    def index_information(self) -> dict:
+        info = {'_id_': {'key': [('_id', 1)]}}
+        info.update((name, dict(spec)) for name, spec in self._indexes.items())
+        return info
+
+    @_command('dropIndexes')
+    def drop_indexes(self):
+        with self._lock:
+            self._indexes.clear()
+            self._unique.clear()
+            self._persist()
+
+    def __repr__(self):
+        return f'MemoryCollection({self.full_name!r})'
+
+
+class MemoryCursor:
+
+    def __init__(self, collection: MemoryCollection, filter=None, projection=None):
+        self.collection = collection
+        self._filter = filter or {}
+        self._projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction=None) -> 'MemoryCursor':
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction or pymongo.ASCENDING)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def skip(self, skip: int) -> 'MemoryCursor':
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int) -> 'MemoryCursor':
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int) -> 'MemoryCursor':
+        return self
+
+    @_command('find')
+    def _execute(self) -> list:
+        with self.collection._lock:
+            docs = _sort(self.collection._find(self._filter), self._sort)
+            docs = docs[self._skip:]
+            if self._limit:
+                docs = docs[:abs(self._limit)]
+            return [_project(doc, self._projection) for doc in docs]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        if self._results is None:
+            self._results = iter(self._execute())
+        return next(self._results)
+
+    @_command('count')
+    def count(self, with_limit_and_skip=False) -> int:
+        with self.collection._lock:
+            count = len(self.collection._find(self._filter))
+        if with_limit_and_skip:
+            count = max(count - self._skip, 0)
+            if self._limit:
+                count = min(count, abs(self._limit))
+        return count
+
+    def close(self):
+        self._results = iter(())
+
+    def __getitem__(self, index: int) -> dict:
+        return self._execute()[index]
@@ -1,27 +1,37 @@
 import datetime
 import bson.json_util
+import http.server
 import os
+import pymongo
 import pytest
+import threading
 
 from collections import OrderedDict
 from freezegun import freeze_time
 
+# 默认使用进程内存储 设置 MONGO_URI 可针对 MongoDB 运行
+os.environ.setdefault('MONGO_URI', 'memory://')
+
 # setup a test tournament
 from worldcup import config
 config.TOURNAMENTS.append(config.Tournament(dbname='veryhard', league='欧联', display='硬糙', weight_schedule=[]))
 config.DEFAULT_TOURNAMENT = config.TOURNAMENTS[-1]
 
-from worldcup.app import app, logindb, tournamentdb as db
-from worldcup import model
+from worldcup.app import app, logindb, tournamentdb as db, _board_cache as board_cache
+from worldcup import storage
+from worldcup import bench, metrics, model, match_getter
 
 
 def drop_all():
+    model.clear_caches()
     # login
     logindb.user.drop()
     # tournament
     db.gambler.drop()
     db.match.drop()
     db.auction.drop()
+    db.ledger.drop()
+    db.meta.drop()
 
 
 @pytest.fixture(autouse=True)
@@ -122,6 +132,36 @@ def test_find_one_user(g1u):
     assert model.find_user_by_name('non-existent') is None
 
 
+def test_find_user_by_openid_cached(g1u):
+    assert model.find_user_by_openid(g1u.openid) == g1u
+    assert model.find_user_by_openid('non-existent') is None
+
+    # 缓存命中时不再查询数据库
+    logindb.user.delete_many({})
+    assert model.find_user_by_openid(g1u.openid) == g1u
+
+    # insert_user / drop_user 使缓存失效
+    model.insert_user(name='new', openid='non-existent')
+    assert model.find_user_by_openid('non-existent') == 'new'
+    model.drop_user('non-existent')
+    assert model.find_user_by_openid('non-existent') is None
+
+
+def test_find_user_by_openid_miss_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(model.time, 'monotonic', lambda: now[0])
+    assert model.find_user_by_openid('openid-new') is None
+
+    # 其他进程注册后 未知 openid 的缓存很快过期
+    logindb.user.insert_one({'name': 'new', 'openid': 'openid-new'})
+    assert model.find_user_by_openid('openid-new') is None
+    now[0] += model.USER_CACHE_MISS_TTL + 1
+    assert model.find_user_by_openid('openid-new') == 'new'
+    now[0] += model.USER_CACHE_MISS_TTL + 1
+    logindb.user.delete_many({})
+    assert model.find_user_by_openid('openid-new') == 'new'
+
+
 def test_model_find_gamblers(g1, g2, g3, g4):
     gamblers_found = model.find_gamblers()
     assert gamblers_found == [g1, g2, g3, g4]
@@ -138,11 +178,40 @@ def test_model_find_team_owner(auction2, g4):
     assert team_owner == g4
 
 
+def test_model_find_team_owner_cached(auction2, g4):
+    assert model.find_team_owner(team='纽尔联') == g4
+    # 同一 app context 内 owner 只从 auction 集合加载一次
+    db.auction.delete_many({})
+    assert model.find_team_owner(team='纽尔联') == g4
+    # insert_auction 使缓存失效
+    model.insert_auction(team='纽尔联', gambler='g1', price=7)
+    assert model.find_team_owner(team='纽尔联') == 'g1'
+    assert model.find_team_owner(team='水宫') is None
+
+
 def test_model_find_match_by_id(match1):
     found = model.find_match_by_id(match1.id)
     assert found == match1
 
 
+def test_model_match_from_mongo(auction2, match1, match2):
+    # 直接使用存储的字段 与经 __init__ 构造的结果相同
+    for match in (match1, match2):
+        found = model.find_match_by_id(match.id)
+        assert found == match and found.handicap == match.handicap
+        assert found.a == match.a and found.b == match.b
+    assert model.find_match_by_id(match1.id).b['owner'] == 'g3'
+
+    side = model.find_match_by_id(match1.id).a
+    assert side['team'] == side.team == '水宫' and side.get('score') == 2 and side.get('no-such-key') is None
+    side['score'] = 3
+    assert side.score == 3
+    with pytest.raises(KeyError):
+        side['no-such-key'] = 1
+    with pytest.raises(AttributeError):
+        match1.no_such_attr = 1
+
+
 def test_model_find_matches(match1, match2):
     matches_found = model.find_matches(reverse=False)
     assert matches_found == [match1, match2]
@@ -150,6 +219,11 @@ def test_model_find_matches(match1, match2):
     matches_found = model.find_matches(reverse=True, limit=1)
     assert matches_found == [match2]
 
+    # 翻页
+    assert model.find_matches(reverse=True, limit=1, before_id=match2.id) == [match1]
+    assert model.find_matches(reverse=True, before_id=match1.id) == []
+    assert model.find_matches(after_id=match1.id) == [match2]
+
 
 ##########
 # data manipulation tests
@@ -200,6 +274,18 @@ def test_model_update_user_name(auction2, match1, match2, g1, g2):
     # auction
     assert db.auction.find({'gambler': G2_NEW}).count() == 2
 
+    # ledger 不以玩家名作字段名 名字含 '.' 或以 '$' 开头也可以改名
+    model.update_match_score(match1.id, '1', '0')
+    model.update_user_name(current=G1_NEW, new='$g1')
+    model.update_user_name(current=G2_NEW, new='Mr.X')
+    assert db.meta.find_one({'_id': 'ledger'}).get('stale') is None
+    assert _series_dicts(model.find_series()) == _series_dicts(model.generate_series())
+    assert {'$g1', 'Mr.X'} <= {series.gambler for series in model.find_series()}
+
+    # 旧名字被新用户使用 投注时重新报名
+    model.update_match_gamblers(match2.id, 'a', model.Gambler('g1'), cutoff_check=False)
+    assert db.gambler.find({'name': 'g1'}).count() == 1
+
 
 def test_model_update_match_score(match1):
     model.update_match_score(match1.id, "1", "0")
@@ -253,6 +339,81 @@ def test_model_update_match_gamblers(match1, g1):
         assert 'g1' not in match_found.a['gamblers'] and 'g1' in match_found.b['gamblers']
 
 
+def test_model_update_match_gamblers_accepted(match1, g1):
+    # 盘口未定 / 开赛后 / 比赛不存在 投注失败
+    with freeze_time('2018-03-31 03:59:59'):
+        assert model.update_match_gamblers(match1.id, 'a', g1) is False
+    with freeze_time('2018-03-31 11:30:01'):
+        assert model.update_match_gamblers(match1.id, 'a', g1) is False
+    with freeze_time('2018-03-31 04:00:01'):
+        assert model.update_match_gamblers('no-such-match', 'a', g1) is False
+        assert model.update_match_gamblers(match1.id, 'a', g1) is True
+
+
+def test_model_bet_queue(match1, match2, g1, g2, g3):
+    queue = model.BetQueue(interval=3600, batch_size=100)
+    with freeze_time('2018-03-31 04:00:01'):
+        queue.submit(match1.id, 'a', g1)
+        queue.submit(match1.id, 'b', g1)
+        queue.submit(match1.id, 'a', g2)
+        queue.submit(match2.id, 'b', g2)
+        with pytest.raises(ValueError):
+            queue.submit(match1.id, 'c', g1)
+        # 尚未写入 叠加展示
+        assert queue.pending() == {(match1.id, 'g1'): 'b', (match1.id, 'g2'): 'a', (match2.id, 'g2'): 'b'}
+        shown, = queue.apply([model.find_match_by_id(match1.id)])
+        assert shown.a['gamblers'] == ['g2'] and shown.b['gamblers'] == ['g1']
+        assert model.find_match_by_id(match1.id).a['gamblers'] == []
+    # 开赛后的投注在写入时被拒绝
+    with freeze_time('2018-03-31 11:30:01'):
+        queue.submit(match1.id, 'a', g3)
+
+    # 写入时已开赛 以投注时刻为准
+    with freeze_time('2018-03-31 12:00:00'):
+        assert queue.flush() == 3
+    assert queue.pending() == {}
+    found1, found2 = model.find_match_by_id(match1.id), model.find_match_by_id(match2.id)
+    assert found1.a['gamblers'] == ['g2'] and found1.b['gamblers'] == ['g1']
+    assert found2.a['gamblers'] == [] and found2.b['gamblers'] == ['g2']
+
+
+def test_model_bet_queue_flush_failure(match1, g1, monkeypatch):
+    queue = model.BetQueue(interval=3600, batch_size=100)
+    flush_tournament = queue._flush_tournament
+
+    def _flush_tournament(dbname, bets):
+        if dbname == 'broken':
+            raise ConnectionError('database unavailable')
+        return flush_tournament(dbname, bets)
+
+    monkeypatch.setattr(queue, '_flush_tournament', _flush_tournament)
+    with freeze_time('2018-03-31 04:00:01'):
+        queue._pending[('broken', match1.id, 'g1')] = ('a', datetime.datetime(2018, 3, 31, 12, 0, 1))
+        queue.submit(match1.id, 'a', g1)
+        with pytest.raises(RuntimeError, match='broken: ConnectionError'):
+            queue.flush()
+    # 其他 tournament 照常写入 失败的投注放回队列
+    assert model.find_match_by_id(match1.id).a['gamblers'] == ['g1']
+    assert list(queue._pending) == [('broken', match1.id, 'g1')]
+    queue._pending.clear()
+
+
+@pytest.mark.parametrize('match_time', [
+    datetime.datetime(2018, 3, 31, 11, 59),
+    datetime.datetime(2018, 3, 31, 12, 0),
+    datetime.datetime(2018, 3, 31, 12, 1),
+    datetime.datetime(2018, 3, 31, 19, 30),
+    datetime.datetime(2018, 4, 1, 3, 0),
+])
+def test_model_bet_window(match_time):
+    match = model.Match('硬糙', match_time, '平手', '水宫', '利浦', 1.9, 1.9, '', '')
+    for minutes in range(-36 * 60, 36 * 60, 60):
+        now = match_time + datetime.timedelta(minutes=minutes)
+        window = model._bet_window(now)
+        with freeze_time(now - datetime.timedelta(hours=8)):
+            assert match.can_bet() == (window['$gte'] <= match_time <= window['$lte'])
+
+
 def test_model_update_match_gamblers_signup(match1, u0):
     assert model.find_gamblers() == []
     model.update_match_gamblers(match1.id, 'a', u0, cutoff_check=False)
@@ -408,6 +569,561 @@ def test_model_generate_series(g1, g2, g3, g4, match1, match2):
     assert results == expected
 
 
+def _series_dicts(many_series):
+    return [series.__dict__ for series in many_series]
+
+
+def test_model_find_series(g1, g2, g3, g4, match1, match2):
+    assert _series_dicts(model.find_series()) == _series_dicts(model.generate_series())
+
+    model.update_match_gamblers(match1.id, 'a', g1, cutoff_check=False)
+    model.update_match_gamblers(match2.id, 'b', g2, cutoff_check=False)
+    assert _series_dicts(model.find_series()) == _series_dicts(model.generate_series())
+
+    model.update_match_score(match1.id, '3', '0')
+    model.update_match_weight(match2.id, 4)
+    model.update_match_handicap(match2.id, '受一球', cutoff_check=False)
+    model.insert_auction(team='水宫', gambler='g1', price=1)
+    assert _series_dicts(model.find_series()) == _series_dicts(model.generate_series())
+
+    # 新玩家加入 重建 ledger
+    model.insert_gambler('g5')
+    assert _series_dicts(model.find_series()) == _series_dicts(model.generate_series())
+
+
+def test_model_ensure_ledger(g1, g2, match1, match2):
+    # 旧数据没有 ledger 首次读取时重建
+    db.ledger.drop()
+    db.meta.drop()
+    assert model.ensure_ledger()
+    assert not model.ensure_ledger()
+    assert db.ledger.find().count() == 2
+
+    # 新玩家加入只标记过期 读取时重建
+    model.insert_gambler('g5')
+    assert db.meta.find_one({'_id': 'ledger'})['stale']
+    assert _series_dicts(model.find_series()) == _series_dicts(model.generate_series())
+    assert 'stale' not in db.meta.find_one({'_id': 'ledger'})
+
+    # 其他进程持有写锁
+    with model._ledger_lock():
+        with pytest.raises(model.LedgerLocked):
+            model.update_ledger(match1.id, wait=0)
+        model.invalidate_ledger()
+        assert not model.ensure_ledger()
+    assert db.meta.find_one({'_id': 'ledger_lock'}) is None
+    assert model.ensure_ledger()
+
+
+def test_model_find_version(match1):
+    version, updated_at = model.find_version()
+    model.update_match_score(match1.id, '1', '0')
+    assert model.find_version()[0] != version
+    assert model.find_version()[1] >= (updated_at or datetime.datetime.min)
+
+
+def test_model_downsample_series():
+    match_ids = ['2018062{}{:02d}00-a-b'.format(day, hour) for day in range(1, 10) for hour in range(24)]
+    many_series = [model.Series('g1'), model.Series('g2')]
+    for i, match_id in enumerate(match_ids):
+        many_series[0].add_point(match_id, (-1) ** i * i)
+        many_series[1].add_point(match_id, 1)
+    weight_schedule = [(datetime.datetime(2018, 6, 23), 2), (datetime.datetime(2018, 6, 26), 4)]
+    boundaries = ['201806222300-a-b', '201806252300-a-b', match_ids[-1]]
+
+    # 每轮最后一场
+    sampled = model.downsample_series(many_series, 0, 'round', weight_schedule)
+    assert list(sampled[0].points) == boundaries
+    assert [sampled[1].points[k] for k in boundaries] == [many_series[1].points[k] for k in boundaries]
+
+    # lttb 点数有上限 且保留分界点的精确值
+    sampled = model.downsample_series(many_series, 20, 'lttb', weight_schedule)
+    assert len(sampled[0].points) <= 20 + len(boundaries)
+    assert list(sampled[0].points)[0] == match_ids[0]
+    for k in boundaries:
+        assert sampled[0].points[k] == many_series[0].points[k]
+
+    # 点数未超出时不降采样
+    assert model.downsample_series(many_series, 1000, 'lttb', weight_schedule) is many_series
+
+
+def _collection_scans(plan):
+    """返回查询计划中的 COLLSCAN stage"""
+    if isinstance(plan, dict):
+        return ([plan] if plan.get('stage') == 'COLLSCAN' else []) + _collection_scans(list(plan.values()))
+    if isinstance(plan, list):
+        return [s for p in plan for s in _collection_scans(p)]
+    return []
+
+
+def test_model_ensure_indexes():
+    # 集合删除后索引缺失 ensure_indexes() 后齐全
+    assert model.missing_indexes() != []
+    model.ensure_indexes()
+    assert model.missing_indexes() == []
+
+
+# 查询计划只有 MongoDB 提供 运行: MONGO_URI=mongodb://127.0.0.1:27017 pytest worldcup/test.py
+requires_mongodb = pytest.mark.skipif(not os.environ['MONGO_URI'].startswith('mongodb'),
+                                      reason='query plans need MONGO_URI=mongodb://...')
+
+
+@requires_mongodb
+def test_model_index_plans():
+    model.ensure_indexes()
+    hot_queries = [
+        logindb.user.find({'openid': 'openid-g1'}),
+        logindb.user.find({'name': 'g1'}),
+        db.match.find({'id': '201803311930-水宫-利浦'}),
+        db.match.find({'match_time': {'$gte': datetime.datetime(2018, 3, 31)}}).sort('match_time'),
+        db.match.find({'a.gamblers': 'g1'}),
+        db.match.find({'b.gamblers': 'g1'}),
+        db.match.find({'$or': [{'a.team': '水宫'}, {'b.team': '水宫'}]}),
+        db.auction.find({'team': '水宫'}),
+        db.gambler.find({'name': 'g1'}),
+        db.ledger.find({'id': '201803311930-水宫-利浦'}),
+        db.ledger.find({'match_time': {'$gte': datetime.datetime(2018, 3, 31)}}).sort(model.LEDGER_ORDER),
+    ]
+    for cursor in hot_queries:
+        assert _collection_scans(cursor.explain()['queryPlanner']['winningPlan']) == []
+
+
+def test_storage_sqlite(tmpdir):
+    uri = 'sqlite:///' + str(tmpdir.join('bet.sqlite3'))
+    client = storage.connect(uri)
+    match = client['t'].match
+    match.insert_many([
+        dict(id='2', match_time=datetime.datetime(2018, 7, 1, 22), a=dict(gamblers=['g1', 'g2'])),
+        dict(id='1', match_time=datetime.datetime(2018, 7, 1, 18), a=dict(gamblers=[])),
+    ])
+    match.update_many({'a.gamblers': 'g1'}, {'$set': {'a.gamblers.$': 'g3'}})
+    match.update_one({'id': '3'}, {'$setOnInsert': {'a': {'gamblers': []}}, '$set': {'score': 1}}, upsert=True)
+    match.create_indexes(model.TOURNAMENT_INDEXES['match'])
+    client.close()
+
+    # 重新打开后数据 / 类型 / 索引不变
+    match = storage.connect(uri)['t'].match
+    assert [d['id'] for d in match.find({'match_time': {'$gte': datetime.datetime(2018, 7, 1)}}).sort('match_time')] \
+        == ['1', '2']
+    assert match.find_one({'id': '2'}, {'_id': 0, 'a.gamblers': 1}) == {'a': {'gamblers': ['g3', 'g2']}}
+    assert match.find_one({'id': '3'}, {'_id': 0}) == {'id': '3', 'a': {'gamblers': []}, 'score': 1}
+    assert match.find({'score': None}).count() == 2
+    assert 'id_1' in match.index_information()
+
+    # 重新打开后仍检查 unique
+    with pytest.raises(pymongo.errors.DuplicateKeyError):
+        match.insert_one(dict(id='1'))
+
+
+def test_storage_unique_index():
+    gambler = storage.connect('memory://')['t'].gambler
+    gambler.insert_many([dict(name='g1'), dict(name='g2')])
+    gambler.create_index('name', unique=True)
+
+    for write in (lambda: gambler.insert_one(dict(name='g1')),
+                  lambda: gambler.update_one({'name': 'g2'}, {'$set': {'name': 'g1'}}),
+                  lambda: gambler.replace_one({'name': 'g2'}, dict(name='g1')),
+                  lambda: gambler.update_one({'name': 'g1', 'x': 1}, {'$set': {'x': 2}}, upsert=True),
+                  lambda: gambler.bulk_write([pymongo.InsertOne(dict(name='g2'))])):
+        with pytest.raises(pymongo.errors.DuplicateKeyError):
+            write()
+    assert sorted(d['name'] for d in gambler.find()) == ['g1', 'g2']
+
+    # 删除或改名后可以再次使用
+    gambler.update_one({'name': 'g2'}, {'$set': {'name': 'g3'}})
+    gambler.delete_one({'name': 'g1'})
+    gambler.insert_many([dict(name='g1'), dict(name='g2')])
+    assert gambler.find().count() == 3
+
+    # 已有重复值时无法创建 unique 索引
+    with pytest.raises(pymongo.errors.DuplicateKeyError):
+        gambler.create_index('x', unique=True)
+    assert 'x_1' not in gambler.index_information()
+
+
+##########
+# view tests
+##########
+
+
+@pytest.fixture
+def client(g1u):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['openid'] = g1u.openid
+    return client
+
+
+def test_view_api_board_conditional_get(client, g1, match1):
+    r = client.get('/api/board')
+    assert r.status_code == 200 and r.headers['ETag']
+
+    # 数据未变化 返回 304
+    r304 = client.get('/api/board', headers={'If-None-Match': r.headers['ETag']})
+    assert r304.status_code == 304 and r304.headers['ETag'] == r.headers['ETag']
+
+    # 比分更新后版本变化
+    model.update_match_score(match1.id, '0', '0')
+    r = client.get('/api/board', headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 200 and r.headers['ETag'] != r304.headers['ETag']
+
+
+def test_view_api_board_since(client, g1, match1, match2):
+    def get(**params):
+        return client.get('/api/board', query_string=params).get_json()
+
+    full = get()
+    assert full['full'] and full['ids'] == ['', match1.id, match2.id]
+    assert full['datasets'][0]['data'] == [0, -2.0, -4.0]
+
+    delta = get(version=full['version'], since=match1.id)
+    assert not delta['full'] and delta['ids'] == [match2.id]
+    assert delta['datasets'][0]['data'] == [-4.0]
+
+    # 未知的 since 或未指定 version 返回全量
+    assert get(version=full['version'], since='unknown')['full']
+    assert get(since=match1.id)['full']
+
+    # 新结算的比赛排在最后 返回增量
+    match3 = model.insert_match('硬糙', datetime.datetime(2018, 4, 1, 19, 30), '受一球', '水宫', '利浦', 2.08, 1.78, 1, 0)
+    delta = get(version=full['version'], since=match2.id)
+    assert not delta['full'] and delta['ids'] == [match3.id]
+
+    # 已有比赛变化 (修改权重 补录之前的比分 新玩家加入) 后返回全量
+    model.update_match_weight(match1.id, 4)
+    full = get(version=delta['version'], since=match3.id)
+    assert full['full'] and full['datasets'][0]['data'] == [0, -4.0, -6.0, -8.0]
+    model.update_match_score(match1.id, '0', '0')
+    assert get(version=full['version'], since=match3.id)['full']
+    version = get()['version']
+    model.insert_gambler('g5')
+    assert get(version=version, since=match3.id)['full']
+
+    r = client.get('/api/board', headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip'
+
+
+def test_view_api_board_points(client, g1, match1, match2, monkeypatch):
+    monkeypatch.setitem(app.config, 'BOARD_MAX_POINTS', 2)
+    board_cache.clear()
+    etags = {client.get('/api/board', query_string=dict(mode='lttb', points=n)).headers['ETag'] for n in (2, 3, 1000)}
+    # points 超出 BOARD_MAX_POINTS 时按上限处理 不产生新的缓存
+    assert len(etags) == 1
+    assert len(board_cache._data) == 1
+
+
+def test_view_db_stats(client, g1, auction2, match1, match2, caplog, monkeypatch):
+    monkeypatch.setitem(app.config, 'DB_SERVER_TIMING', True)
+    client.get('/')     # 登录用户已缓存
+    timing = client.get('/').headers['Server-Timing']
+    assert timing.startswith('db;desc="') and ';dur=' in timing
+    # owner 只查询一次 命令数与比赛数无关
+    assert 0 < int(timing.split('"')[1].split()[0]) <= 2
+
+    # 清除缓存后 user / match 各查询一次 超出上限
+    monkeypatch.setitem(app.config, 'DB_QUERY_BUDGET', 1)
+    model.clear_caches()
+    with caplog.at_level('WARNING'):
+        client.get('/')
+    assert 'endpoint=index exceeded query budget 1' in caplog.text
+
+
+def test_view_metrics(client, g1, match1):
+    # 指标在进程内累计 只比较增量
+    count, _ = metrics.REQUEST_DURATION.get(endpoint='index')
+    client.get('/')
+    client.get('/')
+    model.generate_series()
+    text = client.get('/metrics').get_data(as_text=True)
+
+    assert metrics.REQUEST_DURATION.get(endpoint='index')[0] == count + 2
+    assert '# TYPE bet_web_request_duration_seconds histogram' in text
+    assert f'bet_web_request_duration_seconds_count{{endpoint="index"}} {count + 2}' in text
+    assert f'bet_web_request_duration_seconds_bucket{{endpoint="index",le="+Inf"}} {count + 2}' in text
+    assert 'bet_web_settlement_duration_seconds_count{operation="generate_series"}' in text
+    assert 'bet_web_cache_requests_total{cache="user",result="hit"}' in text
+
+
+def test_view_metrics_error(client, monkeypatch):
+    def rule():
+        raise RuntimeError('view failed')
+
+    # view 抛出异常的请求同样记录耗时
+    monkeypatch.setitem(app.view_functions, 'rule', rule)
+    count, _ = metrics.REQUEST_DURATION.get(endpoint='rule')
+    assert client.get('/rule').status_code == 500
+    assert metrics.REQUEST_DURATION.get(endpoint='rule')[0] == count + 1
+    # 异常未被处理 (如调试模式) 时 after_request 不会执行
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', True)
+    monkeypatch.setitem(app.config, 'PRESERVE_CONTEXT_ON_EXCEPTION', False)
+    with pytest.raises(RuntimeError):
+        client.get('/rule')
+    assert metrics.REQUEST_DURATION.get(endpoint='rule')[0] == count + 2
+
+
+def test_metrics_histogram():
+    histogram = metrics.Histogram('latency_seconds', 'Latency.', ['endpoint'], buckets=(0.1, 1))
+    histogram.observe(0.05, endpoint='a"b')
+    histogram.observe(0.5, endpoint='a"b')
+    assert histogram.get(endpoint='a"b') == (2, 0.55)
+    assert histogram.render().splitlines()[2:] == [
+        'latency_seconds_bucket{endpoint="a\\"b",le="0.1"} 1',
+        'latency_seconds_bucket{endpoint="a\\"b",le="1"} 2',
+        'latency_seconds_bucket{endpoint="a\\"b",le="+Inf"} 2',
+        'latency_seconds_sum{endpoint="a\\"b"} 0.55',
+        'latency_seconds_count{endpoint="a\\"b"} 2',
+    ]
+    with pytest.raises(ValueError):
+        histogram.observe(1, method='GET')
+
+
+def test_view_more_matches(client, g1, match1, match2):
+    html = client.get('/matches', query_string={'before': match2.id}).get_data(as_text=True)
+    assert match1.id in html and match2.id not in html
+    assert 'match-container' not in client.get('/matches', query_string={'before': match1.id}).get_data(as_text=True)
+
+
+@pytest.mark.parametrize('bet_queue', [False, True])
+def test_view_api_bet(client, g1, match1, auction2, bet_queue, monkeypatch):
+    monkeypatch.setitem(app.config, 'BET_QUEUE', bet_queue)
+    monkeypatch.setattr(model, 'bet_queue', model.BetQueue(interval=3600, batch_size=100))
+
+    def post(bet_choice, match_id=match1.id):
+        # session 须在冻结的时间内签名 否则会被视作未来签发而失效
+        with client.session_transaction() as session:
+            session['openid'] = g1.openid
+        return client.post('/api/bet', data={'match-id': match_id, 'bet-choice': bet_choice})
+
+    with freeze_time('2018-03-31 04:00:01'):
+        data = post('b').get_json()
+        assert data['accepted'] and data['match']['id'] == match1.id and data['match']['can_bet']
+        assert data['match']['a'] == dict(team='水宫', owner='g4', score=2, gamblers=[])
+        assert data['match']['b']['gamblers'] == ['g1'] and data['match']['b']['owner'] == 'g3'
+        model.bet_queue.flush()
+
+    # 开赛后投注失败 返回当前投注情况
+    with freeze_time('2018-03-31 11:30:01'):
+        data = post('a').get_json()
+        assert not data['accepted'] and not data['match']['can_bet']
+        assert data['match']['a']['gamblers'] == [] and data['match']['b']['gamblers'] == ['g1']
+
+        assert post('c').status_code == 400
+        assert post('a', match_id='no-such-match').status_code == 404
+        # 被拒绝的投注不放入队列
+        assert model.bet_queue.pending() == {}
+
+
+##########
+# match getter tests
+##########
+
+
+TESTDATA = os.path.join(os.path.dirname(__file__), 'testdata')
+
+
+@pytest.fixture
+def odds_server():
+    """本地 HTTP 服务 以保存的新浪赔率页面响应所有请求"""
+    with open(os.path.join(TESTDATA, 'odds-20180715.html'), 'rb') as f:
+        page = f.read()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        paths = []
+
+        def do_GET(self):
+            self.paths.append(self.path)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=gb2312')
+            self.send_header('Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = 'http://127.0.0.1:{}/odds/index.php'.format(server.server_port)
+    server.paths = Handler.paths
+    yield server
+    server.shutdown()
+
+
+@pytest.mark.parametrize('filename', sorted(f for f in os.listdir(TESTDATA) if f.startswith('odds-')))
+def test_match_getter_parsers(filename):
+    with open(os.path.join(TESTDATA, filename), encoding='GBK') as f:
+        page = f.read()
+    date = datetime.date(2018, 7, 15)
+    results = [match_getter.parse_match_page(page, date, parser=parser) for parser in match_getter.PARSERS]
+    assert all(r == results[0] for r in results)
+
+
+def test_match_getter_parse_rows_skip():
+    # 空行 / 首列为空 / 当日无比赛
+    rows = [{}, {0: [], 1: ['22:00']}, {0: ['暂无数据']}]
+    assert match_getter._parse_rows(rows, datetime.date(2018, 7, 15)) == []
+
+
+def test_cli_bench_parser(tmpdir):
+    with open(os.path.join(TESTDATA, 'odds-20180715.html'), encoding='GBK') as f:
+        page = f.read()
+    # PageCache 保存的页面
+    match_getter.PageCache(str(tmpdir)).save('世界杯', datetime.date(2018, 7, 15), page, {})
+    pages = [str(p) for p in tmpdir.visit('*.json')]
+    r = app.test_cli_runner().invoke(args=['bench_parser', '--repeat', '1'] + pages)
+    assert r.exit_code == 0 and '✅ parsers agree on 1 pages' in r.output
+
+
+def test_match_getter_fetch_match_data(odds_server):
+    dates = [datetime.datetime(2018, 7, 15) + datetime.timedelta(days=i) for i in range(3)]
+    results = match_getter.fetch_match_data('世界杯', dates, url=odds_server.url)
+
+    assert [date for date, _ in results] == dates
+    assert len(odds_server.paths) == 3
+    for date, matches in results:
+        assert [m[3:5] for m in matches] == [['法国', '克罗地亚'], ['比利时', '英格兰'], ['巴西', '瑞士']]
+        assert matches[0][1] == date.replace(hour=22)
+
+
+def test_match_getter_populate_and_update(odds_server):
+    with freeze_time('2018-07-14 00:00:00'):
+        result = match_getter.populate_and_update('世界杯', [], k=0, current_date=datetime.datetime(2018, 7, 15),
+                                                  url=odds_server.url)
+    assert result == (6, 0, 0)
+
+    match = model.find_match_by_id('201807152200-法国-克罗地亚')
+    assert match.handicap_display == '一球/球半' and (match.a['score'], match.b['score']) == (4, 2)
+    assert model.find_match_by_id('201807152300-巴西-瑞士').has_score() is False
+    # 前一天及当天各抓取一次
+    assert len(model.find_matches()) == 6
+
+    # 再次抓取 数据未变化
+    with freeze_time('2018-07-14 00:00:00'):
+        result = match_getter.populate_and_update('世界杯', [], k=0, current_date=datetime.datetime(2018, 7, 15),
+                                                  url=odds_server.url)
+    assert result == (0, 0, 6)
+
+
+def test_match_getter_populate_partial_failure(odds_server, monkeypatch):
+    get_match_page = match_getter.get_match_page
+
+    def flaky(league, date, **kwargs):
+        if date.day == 14:
+            raise ConnectionError('connection reset')
+        return get_match_page(league, date, **kwargs)
+
+    monkeypatch.setattr(match_getter, 'get_match_page', flaky)
+    # 前一天获取失败 当天的比赛仍然写入 之后抛出异常
+    with freeze_time('2018-07-14 00:00:00'), pytest.raises(ConnectionError):
+        match_getter.populate_and_update('世界杯', [], k=0, current_date=datetime.datetime(2018, 7, 15),
+                                         url=odds_server.url)
+    assert len(model.find_matches()) == 3
+
+    errors = []
+    dates = [datetime.datetime(2018, 7, 14), datetime.datetime(2018, 7, 15)]
+    pages = match_getter.fetch_match_pages('世界杯', dates, url=odds_server.url, errors=errors)
+    assert [date for date, _ in pages] == dates[1:] and [date for date, _ in errors] == dates[:1]
+
+
+def test_match_getter_page_cache(odds_server, tmpdir):
+    cache = match_getter.PageCache(str(tmpdir))
+    kwargs = dict(k=0, current_date=datetime.datetime(2018, 7, 15), url=odds_server.url, cache=cache)
+
+    with freeze_time('2018-07-14 00:00:00'):
+        assert match_getter.populate_and_update('世界杯', [], **kwargs) == (6, 0, 0)
+        # 页面未变化 跳过解析及写入
+        assert match_getter.populate_and_update('世界杯', [], **kwargs) == (0, 0, 6)
+
+        # 行未变化 跳过写入
+        date = datetime.datetime(2018, 7, 15)
+        entry = cache.load('世界杯', date)
+        assert match_getter.populate_page('世界杯', [], date, entry['page'] + ' ', cache=cache) == (0, 0, 3)
+
+        # 离线重放 不发起网络请求
+        db.match.drop()
+        requested = len(odds_server.paths)
+        assert match_getter.populate_and_update('世界杯', [], replay=True, **kwargs) == (6, 0, 0)
+        assert len(odds_server.paths) == requested
+
+
+def test_match_getter_poll_plan(match1, match2):
+    # match1 19:30 开赛 match2 22:10 开赛 均无比分
+    db.match.update_many({}, {'$set': {'a.score': None, 'b.score': None}})
+    matches = model.find_unsettled_matches(after=datetime.datetime(2018, 3, 30))
+    assert matches == model.find_matches()
+
+    def plan(hour, minute):
+        return match_getter.poll_plan(matches, datetime.datetime(2018, 3, 31, hour, minute))
+
+    assert plan(9, 0) == ([], match_getter.POLL_IDLE)
+    # 空闲间隔不超过下一次盘口截止 / 开赛进入 NEAR_WINDOW 的时间 最短 POLL_NEAR
+    assert plan(11, 0) == ([], datetime.timedelta(minutes=30))
+    assert plan(11, 29) == ([], match_getter.POLL_NEAR)
+    assert plan(18, 31) == ([], datetime.timedelta(minutes=29))
+    # 盘口截止前
+    assert plan(11, 45) == ([datetime.date(2018, 3, 31)], match_getter.POLL_NEAR)
+    # 临近开赛
+    assert plan(19, 10) == ([datetime.date(2018, 3, 31)], match_getter.POLL_NEAR)
+    # 比赛进行中
+    assert plan(20, 0) == ([datetime.date(2018, 3, 31)], match_getter.POLL_LIVE)
+    # match1 已结束但无比分 match2 仍在进行中
+    assert plan(23, 0) == ([datetime.date(2018, 3, 31)], match_getter.POLL_LIVE)
+    assert match_getter.poll_plan(matches, datetime.datetime(2018, 4, 1, 3, 0)) == (
+        [datetime.date(2018, 3, 31)], match_getter.POLL_PENDING)
+
+
+def test_match_getter_poll_once_idle(match1, caplog):
+    # 没有临近的比赛 且刚全量抓取过 本轮无需抓取任何日期
+    now = datetime.datetime(2018, 3, 30, 9, 0)
+    with caplog.at_level('INFO'):
+        interval, last_full = match_getter._poll_once('硬糙', [], 1, now, now, cache=None)
+    assert (interval, last_full) == (match_getter.POLL_IDLE, now)
+    assert 'Poll failed' not in caplog.text
+    assert match_getter.fetch_match_pages('硬糙', []) == []
+
+
+def test_model_upsert_matches(match1):
+    changed = model.Match('硬糙', match1.match_time, '半球', '水宫', '利浦', 1.5, 1.5, 3, 3, weight=8)
+    new = model.Match('硬糙', datetime.datetime(2018, 4, 1, 19, 30), '平手', '白顿', '斯西', 1.9, 1.9, '', '')
+
+    # 盘口已定 只更新比分
+    with freeze_time('2018-03-31 04:00:01'):
+        assert model.upsert_matches([changed, new]) == (1, 1, 0)
+    found = model.find_match_by_id(match1.id)
+    assert (found.a['score'], found.b['score']) == (3, 3)
+    assert found.handicap_display == '受一球' and found.weight == match1.weight and found.a['premium'] == 2.08
+    assert model.find_match_by_id(new.id) == new
+
+    # 盘口未定 更新盘口
+    with freeze_time('2018-03-31 03:59:59'):
+        assert model.upsert_matches([changed, new]) == (0, 1, 1)
+    assert model.find_match_by_id(match1.id).handicap_display == '半球'
+
+
+def test_model_upsert_matches_unscored(match1, monkeypatch):
+    model.ensure_ledger()
+    version = model.find_version()[0]
+    rebuilds = []
+    monkeypatch.setattr(model, '_rebuild_ledger', rebuilds.append)
+
+    # 只写入未开赛的比赛 不重建 ledger 版本不变
+    fixture = model.Match('硬糙', datetime.datetime(2018, 4, 1, 19, 30), '平手', '白顿', '斯西', 1.9, 1.9, '', '')
+    assert model.upsert_matches([fixture]) == (1, 0, 0)
+    assert rebuilds == [] and model.find_version()[0] == version
+
+
+def test_model_insert_auction_without_matches(match1, monkeypatch):
+    model.ensure_ledger()
+    version = model.find_version()[0]
+    rebuilds = []
+    monkeypatch.setattr(model, '_rebuild_ledger', rebuilds.append)
+
+    # 该队尚无比赛 不重建 ledger
+    model.insert_auction(team='白顿', gambler='g1', price=1)
+    assert rebuilds == [] and model.find_version()[0] == version
+
+
 ##########
 # integration tests
 ##########
@@ -432,6 +1148,9 @@ def test_history_eurocup2016():
     assert db.auction.find().count() == 24
     assert db.match.find().count() == 51
 
+    model.update_ledger()
+    assert _series_dicts(model.find_series()) == _series_dicts(model.generate_series())
+
     # 用第一场和最后一场积分做校验
     # 积分保留两位小数转为字符串做比较
     results = []
@@ -462,6 +1181,9 @@ def test_history_worldcup2018():
     assert db.auction.find().count() == 32
     assert db.match.find().count() == 64
 
+    model.update_ledger()
+    assert _series_dicts(model.find_series()) == _series_dicts(model.generate_series())
+
     # 用第一场和最后一场积分做校验
     # 积分保留两位小数转为字符串做比较
     results = []
@@ -484,3 +1206,92 @@ def test_history_worldcup2018():
     ]
 
     assert results == expected
+
+
+@pytest.mark.parametrize('tournament', ['eurocup2016', 'worldcup2018'])
+def test_kernel_settle_history(tournament):
+    kernel = pytest.importorskip('worldcup.kernel')
+    load_history(tournament)
+
+    gamblers = model.find_gamblers()
+    settlement = kernel.settle(model.find_matches(), gamblers)
+
+    # 批量结算结果须与逐场结算逐位相同
+    latest = dict.fromkeys(settlement.gamblers, 0)
+    for j, (match, result) in enumerate(model.settle_matches(model.iter_matches(order='match_time'), gamblers)):
+        assert settlement.match_ids[j] == match.id
+        for i, name in enumerate(settlement.gamblers):
+            delta = result.get(name) or 0
+            latest[name] += delta
+            assert settlement.results[i, j] == delta
+            assert settlement.totals[i, j] == latest[name]
+    assert len(settlement.match_ids) == j + 1
+
+
+@pytest.mark.parametrize('tournament', ['eurocup2016', 'worldcup2018'])
+def test_model_generate_series_batches(tournament, monkeypatch):
+    load_history(tournament)
+    model.update_ledger()
+    expected = _series_dicts(model.find_series())
+
+    # 分批结算与一次结算逐位相同
+    monkeypatch.setattr(model, 'MATCH_BATCH_SIZE', 7)
+    assert _series_dicts(model.generate_series()) == expected
+    model.update_ledger()
+    assert _series_dicts(model.find_series()) == expected
+
+    matches = list(model.iter_matches(batch_size=5, order='match_time'))
+    assert len(matches) == db.match.find().count()
+    assert [m.match_time for m in matches] == sorted(m.match_time for m in matches)
+
+
+@pytest.mark.parametrize('tournament', ['eurocup2016', 'worldcup2018'])
+def test_model_rebuild_ledger_kernel(tournament, monkeypatch):
+    pytest.importorskip('worldcup.kernel')
+    load_history(tournament)
+
+    def ledger():
+        return list(db.ledger.find({}, {'_id': 0}).sort(model.LEDGER_ORDER))
+
+    # 批量结算重建的 ledger 与逐场结算逐位相同
+    monkeypatch.setattr(model, 'MATCH_BATCH_SIZE', 7)
+    model.update_ledger()
+    expected = ledger()
+    monkeypatch.setattr(model, 'kernel', None)
+    model.update_ledger()
+    assert ledger() == expected
+
+
+def test_cli_import_export_collection(tmpdir):
+    runner = app.test_cli_runner()
+    source = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'history', 'worldcup2018', 'match.json')
+    target = str(tmpdir.join('match.json'))
+
+    r = runner.invoke(args=['import_collection', db.name, 'match', source, '--batch-size', '10'])
+    assert r.exit_code == 0 and '(64 records)' in r.output
+    # 按 id upsert 不产生重复记录
+    r = runner.invoke(args=['import_collection', db.name, 'match', source, '--upsert', 'id'])
+    assert r.exit_code == 0 and db.match.find().count() == 64
+
+    r = runner.invoke(args=['export_collection', db.name, 'match', target])
+    assert r.exit_code == 0
+    with open(source) as f1, open(target) as f2:
+        expected = sorted((bson.json_util.loads(line) for line in f1), key=lambda d: d['_id'])
+        assert [bson.json_util.loads(line) for line in f2] == expected
+
+
+def test_cli_bench(tmpdir):
+    output = str(tmpdir.join('bench.jsonl'))
+    runner = app.test_cli_runner()
+    args = ['bench', '--no-history', '--matches', '20', '--gamblers', '5', '--repeat', '1', '--output', output]
+    r = runner.invoke(args=args)
+    assert r.exit_code == 0, r.output
+
+    results = bench.load_results(output)
+    assert {r['name'] for r in results if r['scenario'] == 'synthetic-20x5'} == {
+        'find_matches', 'generate_series', 'update_profit_and_loss_result',
+        'view:index', 'view:board', 'view:api_board'}
+    assert all(r['seconds'] > 0 for r in results)
+    # 临时数据库已删除
+    assert 'bench-synthetic-20x5' not in [t.dbname for t in config.TOURNAMENTS]
+    assert db.match.find().count() == 0